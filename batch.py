@@ -0,0 +1,266 @@
+# Bulk creates, patches and deletes of books, for POST /books:batch.
+#
+# The body is a JSON array, or NDJSON with one item per line, of items like
+#   {"op": "create", "book": {"title": "...", "author": "...", "illustrator": "..."}}
+#   {"op": "patch", "id": "123", "book": {"title": "..."}}
+#   {"op": "delete", "id": "123"}
+# Every item is checked with the same rules as POST and PATCH /books.  The valid ones are written in chunks of
+# batch_size, so a batch costs a few put_multi and delete_multi calls instead of one request per book.  Creates are
+# written first, then patches, then deletes.  A bad item doesn't stop the rest: the response has a result for every
+# item, in the order they were sent.
+
+import json
+from google.cloud import datastore
+import constants
+import counters
+import entity_cache
+import helper
+import membership
+import search
+import serializers
+import streaming
+import transactions
+
+operations = ["create", "patch", "delete"]
+
+
+# Returns the list of items in the request body.  Raises ValueError if the body isn't a JSON array or NDJSON, or has
+# more than max_batch_items items.
+def get_items(request):
+
+    if request.mimetype == streaming.ndjson:
+
+        lines = request.get_data(as_text=True).splitlines()
+        items = [json.loads(line) for line in lines if line.strip() != ""]
+
+    else:
+
+        items = request.get_json(silent=True)
+
+    if not isinstance(items, list) or len(items) > constants.max_batch_items:
+
+        raise ValueError("The batch is not a list of items, or is too long.")
+
+    return items
+
+
+# Returns the key of the book an item patches or deletes, or None if it doesn't have a valid id.
+def get_book_key(dsClient, item):
+
+    try:
+        return dsClient.key(constants.books, helper.get_body_id(item.get("id")))
+
+    except ValueError:
+
+        return None
+
+
+# Returns true if the item is a valid create, patch or delete.
+def is_valid_item(dsClient, item):
+
+    if not isinstance(item, dict) or item.get("op") not in operations:
+
+        return False
+
+    if item["op"] == "create":
+
+        return helper.is_valid_book(item.get("book"), ["title", "author"])
+
+    if get_book_key(dsClient, item) is None:
+
+        return False
+
+    if item["op"] == "patch":
+
+        return helper.is_valid_book(item.get("book"), [])
+
+    return True
+
+
+def get_error(status, message):
+
+    return {"status": status, "Error": message}
+
+
+# Runs every item in the batch.  Returns {"results": [...]} with one result per item and a 200 status, or an error
+# message and 400 status if the body can't be read.
+def run_batch(dsClient, request):
+
+    try:
+        items = get_items(request)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_batch}, 400
+
+    results = [None] * len(items)
+    work = {op: [] for op in operations}
+
+    for index, item in enumerate(items):
+
+        if is_valid_item(dsClient, item):
+
+            work[item["op"]].append((index, item))
+
+        else:
+
+            results[index] = get_error(400, constants.error_400_batch_item)
+
+    create_books(dsClient, request, work["create"], results)
+    patch_books(dsClient, request, work["patch"], results)
+    delete_books(dsClient, work["delete"], results)
+
+    for index, result in enumerate(results):
+
+        result["index"] = index
+
+    return {"results": results}, 200
+
+
+def get_success(request, status, key):
+
+    return {"status": status, "id": str(key.id), "self": serializers.get_links(request).book(key.id)}
+
+
+# Writes the new books batch_size at a time.  The books counter is updated after every chunk, so books that were
+# written are counted even if a later part of the batch fails.
+def create_books(dsClient, request, creates, results):
+
+    for chunk in helper.get_chunks(creates, constants.batch_size):
+
+        books = []
+
+        for index, item in chunk:
+
+            book = datastore.entity.Entity(key=dsClient.key(constants.books))
+            book.update(helper.get_new_book(item["book"]))
+            books.append(book)
+
+        dsClient.put_multi(books)
+        counters.increment(dsClient, constants.books, len(books))
+
+        for (index, item), book in zip(chunk, books):
+
+            results[index] = get_success(request, 201, book.key)
+
+
+# Applies the patches batch_size at a time.  Each chunk is read and written in one transaction, so a book being put
+# in or taken out of a library at the same time isn't undone.
+def patch_books(dsClient, request, patches, results):
+
+    for chunk in helper.get_chunks(patches, constants.batch_size):
+
+        keys = [get_book_key(dsClient, item) for index, item in chunk]
+
+        def patch_chunk():
+
+            books = helper.get_entities(dsClient, keys)
+            changed = {}
+            outcomes = []
+
+            for (index, item), book in zip(chunk, books):
+
+                if book is None:
+
+                    outcomes.append(get_error(404, constants.error_404_no_book))
+                    continue
+
+                content = item["book"]
+                book.update(helper.get_book_changes(content, helper.getValidKeys(content, ["title", "author",
+                                                                                           "illustrator"])))
+                search.index_book(book)
+                changed[book.key] = book
+                outcomes.append(get_success(request, 200, book.key))
+
+            if len(changed) != 0:
+
+                dsClient.put_multi(list(changed.values()))
+
+            return outcomes
+
+        for (index, item), outcome in zip(chunk, transactions.run_in_transaction(dsClient, patch_chunk)):
+
+            results[index] = outcome
+
+        entity_cache.invalidate(keys)
+
+
+# Deletes the books half a batch at a time, leaving room in each commit for the libraries that lose them.  Like
+# create_books, the books counter is updated after every chunk.
+def delete_books(dsClient, deletes, results):
+
+    for chunk in helper.get_chunks(deletes, constants.batch_size // 2):
+
+        keys = [get_book_key(dsClient, item) for index, item in chunk]
+
+        # The libraries the last attempt took books out of, for the entity cache.
+        libraries_written = []
+
+        def delete_chunk():
+
+            books = helper.get_entities(dsClient, keys)
+            found = {}
+            outcomes = []
+
+            for book in books:
+
+                if book is None or book.key in found:
+
+                    outcomes.append(get_error(404, constants.error_404_no_book))
+                    continue
+
+                found[book.key] = book
+                outcomes.append({"status": 204, "id": str(book.key.id)})
+
+            libraries_written[:] = release_from_libraries(dsClient, found.values())
+
+            if len(found) != 0:
+
+                dsClient.delete_multi(list(found.keys()))
+
+            return outcomes
+
+        outcomes = transactions.run_in_transaction(dsClient, delete_chunk)
+        deleted = 0
+
+        for (index, item), outcome in zip(chunk, outcomes):
+
+            results[index] = outcome
+
+            if outcome["status"] == 204:
+
+                deleted += 1
+
+        if deleted != 0:
+
+            counters.increment(dsClient, constants.books, -deleted)
+
+        entity_cache.invalidate(keys + libraries_written)
+
+
+# Takes the books out of their libraries' lists in the embedded membership mode, like delete_book does.  Returns the
+# keys of the libraries that changed.
+def release_from_libraries(dsClient, books):
+
+    if membership.is_indexed():
+
+        return []
+
+    shelved = [book for book in books if book["library"] is not None]
+    library_keys = list({dsClient.key(constants.libraries, int(book["library"]["id"])) for book in shelved})
+    libraries = dict(zip(library_keys, helper.get_entities(dsClient, library_keys)))
+    changed = {}
+
+    for book in shelved:
+
+        library = libraries[dsClient.key(constants.libraries, int(book["library"]["id"]))]
+
+        if library is not None and membership.remove_book(library, book.key.id):
+
+            changed[library.key] = library
+
+    if len(changed) != 0:
+
+        dsClient.put_multi(list(changed.values()))
+
+    return list(changed.keys())
@@ -0,0 +1,91 @@
+# Cold start benchmark for the app.
+#
+# Starts a fresh Python process --runs times, like App Engine does when it scales up, and in each one times:
+#   import_ms        - importing main, which builds the app and registers every blueprint.
+#   warmup_ms        - the /_ah/warmup request, which creates the storage client and opens its channel.
+#   first_request_ms - the first GET /books after warmup.
+# It reports the median and worst of each across runs as JSON, along with whether importing main had already
+# created a client (it shouldn't have).
+#
+#   STORAGE_BACKEND=memory python benchmarks/cold_start.py --runs 20
+#
+# Set DATASTORE_EMULATOR_HOST and leave STORAGE_BACKEND unset to include the cost of setting up a Datastore client.
+# Pass --no-warmup to see what the first request costs when it has to do the warmup's work itself.
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Runs in each child process.  Prints one JSON line of timings.
+child_script = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+import main
+import storage
+imported = time.perf_counter()
+
+created_on_import = storage.lazy_client.is_created()
+client = main.app.test_client()
+warmed = imported
+
+if sys.argv[1] == "warmup":
+
+    client.get("/_ah/warmup")
+    warmed = time.perf_counter()
+
+response = client.get("/books", headers={"Accept": "application/json"})
+finished = time.perf_counter()
+
+print(json.dumps({"import_ms": (imported - start) * 1000,
+                  "warmup_ms": (warmed - imported) * 1000,
+                  "first_request_ms": (finished - warmed) * 1000,
+                  "status": response.status_code,
+                  "created_on_import": created_on_import}))
+"""
+
+
+def summarize(values):
+
+    return {"median": round(statistics.median(values), 2), "max": round(max(values), 2)}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Cold start benchmark.")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--no-warmup", action="store_true", help="Skip the /_ah/warmup request.")
+    args = parser.parse_args()
+
+    runs = []
+
+    for _ in range(args.runs):
+
+        output = subprocess.run([sys.executable, "-c", child_script, "none" if args.no_warmup else "warmup"],
+                                cwd=root, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    report = {
+        "config": {"runs": args.runs, "warmup": not args.no_warmup,
+                   "backend": os.environ.get("STORAGE_BACKEND", "datastore")},
+        "statuses": sorted({run["status"] for run in runs}),
+        "created_on_import": any(run["created_on_import"] for run in runs),
+    }
+
+    for name in ["import_ms", "warmup_ms", "first_request_ms"]:
+        report[name] = summarize([run[name] for run in runs])
+
+    report["total_ms"] = summarize([run["import_ms"] + run["warmup_ms"] + run["first_request_ms"] for run in runs])
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+# End-to-end HTTP benchmark for the API.
+#
+# Starts the Flask app from main.py on a local port, seeds users, libraries and books, then replays a weighted mix
+# of requests from several client threads over real HTTP.  Reports p50/p95/p99 latency per operation, throughput,
+# and Datastore RPCs per request, as JSON so runs from different releases can be compared.
+#
+#   STORAGE_BACKEND=memory python benchmarks/http_bench.py --users 20 --libraries 50 --books 2000 --requests 5000
+#
+# To run against the Datastore emulator instead, set DATASTORE_EMULATOR_HOST and leave STORAGE_BACKEND unset.
+# RPC counts are read from each response's Server-Timing header, so they work with either backend.
+#
+# Pass --baseline with an earlier run's JSON to fail (exit 1) if any operation's p95 got worse by more than
+# --tolerance.
+#
+# Users authenticate with bearer tokens whose claims are put straight into verify_helper.token_cache, so the run
+# doesn't depend on Google.  Everything after token verification is the real request path.
+
+import argparse
+import collections
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import requests
+from flask import request
+from werkzeug.serving import WSGIRequestHandler, make_server
+import constants
+import helper
+import main
+import storage
+import verify_helper
+
+# Relative weight of each operation in the request mix.
+default_mix = {
+    "list_books": 25,
+    "get_book": 20,
+    "list_libraries": 10,
+    "get_library": 10,
+    "shelve_book": 8,
+    "unshelve_book": 8,
+    "patch_book": 5,
+    "patch_library": 3,
+    "create_book": 4,
+    "delete_book": 3,
+    "list_users": 4,
+}
+
+
+# The server's access log would drown out the report.
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def percentile(values, fraction):
+
+    if len(values) == 0:
+        return None
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+
+    return round(ordered[index], 3)
+
+
+# Adds a token for sub to the verification cache and returns the headers that use it.
+def get_headers(sub):
+
+    token = "bench-token-" + sub
+    claims = {"sub": sub, "iss": constants.google_issuers[0], "exp": time.time() + 24 * 3600}
+    verify_helper.token_cache.set(hashlib.sha256(token.encode("utf-8")).hexdigest(), claims,
+                                  expires_at=claims["exp"])
+
+    return {"Authorization": "Bearer " + token, "Accept": "application/json"}
+
+
+# Returns the number of Datastore RPCs the request made, as reported by metrics.finish_request.
+def get_rpc_count(response):
+
+    match = re.search(r'(?:^|, )datastore;desc="rpcs=(\d+)"', response.headers.get("Server-Timing", ""))
+
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+
+class Workload:
+
+    def __init__(self, base_url, users, libraries, books, seed):
+
+        self.base_url = base_url
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # [{"sub", "headers", "libraries": [ids]}]
+        self.users = []
+        # book id -> library id or None
+        self.books = {}
+
+        run = str(int(time.time()))
+        book_payload = {"title": "Book", "author": "Author", "illustrator": "Illustrator"}
+
+        with main.app.test_request_context("/", json=book_payload):
+
+            for i in range(users):
+
+                sub = "bench-" + run + "-" + str(i)
+                helper.create_user(main.client, request, {"unique_id": sub, "email": sub + "@example.com"})
+                self.users.append({"sub": sub, "headers": get_headers(sub), "libraries": []})
+
+            for i in range(books):
+
+                book, status = helper.create_book(main.client, request)
+                self.books[book["id"]] = None
+
+        session = requests.Session()
+
+        for i in range(libraries):
+
+            owner = self.users[i % len(self.users)]
+            library = {"name": "Library " + str(i), "street_address": str(i) + " Main Street", "county": "Bench",
+                       "state": "Bench"}
+            response = session.post(base_url + "/libraries", json=library, headers=owner["headers"])
+            owner["libraries"].append(response.json()["id"])
+
+        # Shelve half the books so there is something to take out again.
+        book_ids = list(self.books)
+
+        for book_id in book_ids[:len(book_ids) // 2]:
+
+            owner = self.random.choice([u for u in self.users if u["libraries"]])
+            library_id = self.random.choice(owner["libraries"])
+
+            if session.put(base_url + "/libraries/" + library_id + "/books/" + book_id,
+                           headers=owner["headers"]).status_code == 204:
+                self.books[book_id] = library_id
+
+    def pick_book(self, shelved=None):
+
+        with self.lock:
+
+            candidates = [b for b, l in self.books.items() if shelved is None or (l is not None) == shelved]
+
+            if len(candidates) == 0:
+                return None
+
+            return self.random.choice(candidates)
+
+    def pick_owner(self):
+
+        return self.random.choice([u for u in self.users if u["libraries"]])
+
+    # Sends one request for the operation and returns the HTTP response.
+    def run(self, session, operation):
+
+        url = self.base_url
+        user = self.pick_owner()
+        headers = user["headers"]
+
+        if operation == "list_books":
+
+            response = session.get(url + "/books?limit=20", headers=headers)
+            next_url = response.json().get("next")
+
+            # Follow the cursor one page deeper now and then.
+            if next_url and self.random.random() < 0.3:
+                response = session.get(next_url, headers=headers)
+
+            return response
+
+        if operation == "get_book":
+            return session.get(url + "/books/" + (self.pick_book() or "1"), headers=headers)
+
+        if operation == "list_libraries":
+            return session.get(url + "/libraries", headers=headers)
+
+        if operation == "get_library":
+            return session.get(url + "/libraries/" + self.random.choice(user["libraries"]), headers=headers)
+
+        if operation == "shelve_book":
+
+            book_id = self.pick_book(shelved=False) or "1"
+            library_id = self.random.choice(user["libraries"])
+            response = session.put(url + "/libraries/" + library_id + "/books/" + book_id, headers=headers)
+
+            if response.status_code == 204:
+                with self.lock:
+                    self.books[book_id] = library_id
+
+            return response
+
+        if operation == "unshelve_book":
+
+            book_id = self.pick_book(shelved=True) or "1"
+
+            with self.lock:
+                library_id = self.books.get(book_id) or "1"
+
+            owner = next((u for u in self.users if library_id in u["libraries"]), user)
+            response = session.delete(url + "/libraries/" + library_id + "/books/" + book_id,
+                                      headers=owner["headers"])
+
+            if response.status_code == 204:
+                with self.lock:
+                    self.books[book_id] = None
+
+            return response
+
+        if operation == "patch_book":
+            return session.patch(url + "/books/" + (self.pick_book() or "1"), json={"title": "Renamed"},
+                                 headers=headers)
+
+        if operation == "patch_library":
+            return session.patch(url + "/libraries/" + self.random.choice(user["libraries"]),
+                                 json={"name": "Renamed"}, headers=headers)
+
+        if operation == "create_book":
+
+            response = session.post(url + "/books", json={"title": "New", "author": "Author"}, headers=headers)
+
+            if response.status_code == 201:
+                with self.lock:
+                    self.books[response.json()["id"]] = None
+
+            return response
+
+        if operation == "delete_book":
+
+            book_id = self.pick_book()
+
+            with self.lock:
+                self.books.pop(book_id, None)
+
+            return session.delete(url + "/books/" + (book_id or "1"), headers=headers)
+
+        if operation == "list_users":
+            return session.get(url + "/users", headers=headers)
+
+        raise ValueError("Unknown operation " + operation)
+
+
+def main_bench():
+
+    parser = argparse.ArgumentParser(description="End-to-end HTTP benchmark.")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--libraries", type=int, default=20)
+    parser.add_argument("--books", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--baseline", help="An earlier JSON report to compare p95 latencies against.")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    server = make_server("127.0.0.1", 0, main.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:" + str(server.server_port)
+
+    seed_start = time.time()
+    workload = Workload(base_url, args.users, args.libraries, args.books, args.seed)
+    seed_seconds = time.time() - seed_start
+
+    operations = list(default_mix)
+    weights = [default_mix[o] for o in operations]
+    plan = workload.random.choices(operations, weights=weights, k=args.requests)
+    plan_lock = threading.Lock()
+
+    latencies = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    rpc_counts = []
+
+    def client_thread():
+
+        session = requests.Session()
+
+        while True:
+
+            with plan_lock:
+
+                if len(plan) == 0:
+                    return
+
+                operation = plan.pop()
+
+            start = time.perf_counter()
+            response = workload.run(session, operation)
+            elapsed = time.perf_counter() - start
+
+            latencies[operation].append(elapsed * 1000)
+            statuses[operation][response.status_code] += 1
+
+            rpc_count = get_rpc_count(response)
+
+            if rpc_count is not None:
+                rpc_counts.append(rpc_count)
+
+    threads = [threading.Thread(target=client_thread) for _ in range(args.concurrency)]
+    start = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start
+    server.shutdown()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    report = {
+        "config": {"backend": storage.backend, "users": args.users, "libraries": args.libraries,
+                   "books": args.books, "requests": args.requests, "concurrency": args.concurrency,
+                   "seed": args.seed},
+        "seed_seconds": round(seed_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(all_latencies) / elapsed, 1),
+        "rpcs_per_request": None,
+        "latency_ms": {"p50": percentile(all_latencies, 0.5),
+                       "p95": percentile(all_latencies, 0.95),
+                       "p99": percentile(all_latencies, 0.99)},
+        "operations": {},
+    }
+
+    if rpc_counts:
+        report["rpcs_per_request"] = round(sum(rpc_counts) / len(rpc_counts), 2)
+
+    for operation in operations:
+
+        values = latencies[operation]
+
+        report["operations"][operation] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 0.5),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+            "statuses": {str(code): count for code, count in sorted(statuses[operation].items())},
+        }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.baseline:
+
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = []
+
+        for operation, result in report["operations"].items():
+
+            before = baseline.get("operations", {}).get(operation, {}).get("p95_ms")
+
+            if before and result["p95_ms"] and result["p95_ms"] > before * (1 + args.tolerance):
+                regressions.append("%s p95 %.2fms -> %.2fms" % (operation, before, result["p95_ms"]))
+
+        for regression in regressions:
+            print("REGRESSION: " + regression, file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,133 @@
+# Benchmark for GET /books/search.
+#
+# Seeds --books books whose titles, authors and illustrators are drawn from a Zipf-distributed vocabulary, so a
+# few words are in a large share of the books and most are rare, like real titles.  Then it times searches for words
+# of different frequencies, and for pairs of common words, through the app's real request path.  Reports p50/p95
+# latency, Datastore RPCs, match counts and how often the matches were truncated per kind of query, as JSON.
+#
+#   STORAGE_BACKEND=memory python benchmarks/search_bench.py --books 100000 --rounds 50
+#
+# To run against the Datastore emulator instead, set DATASTORE_EMULATOR_HOST and leave STORAGE_BACKEND unset.  The
+# emulator is much slower than Datastore, so only compare its runs with each other.
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Searches for common words rank up to search_candidate_limit books per tier.  Keep them out of the slow request log.
+os.environ.setdefault("SLOW_REQUEST_MS", "60000")
+
+from google.cloud import datastore
+import constants
+import helper
+import main
+import storage
+from http_bench import get_rpc_count, percentile
+
+
+def make_words(count, prefix):
+
+    return [prefix + str(i) for i in range(count)]
+
+
+# Seeds the books.  Returns how many books have each word, most common first.
+def seed(client, books, vocabulary, authors, illustrators, seed_value):
+
+    rng = random.Random(seed_value)
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+    frequency = collections.Counter()
+    entities = []
+
+    for i in range(books):
+
+        title = " ".join(rng.choices(vocabulary, weights=weights, k=rng.randint(2, 6)))
+        content = {"title": title, "author": rng.choice(authors),
+                   "illustrator": rng.choice(illustrators) if rng.random() < 0.6 else None}
+
+        book = datastore.entity.Entity(key=client.key(constants.books))
+        book.update(helper.get_new_book(content))
+        entities.append(book)
+        frequency.update(set(book["search_terms"]))
+
+        if len(entities) == constants.batch_size:
+
+            client.put_multi(entities)
+            entities = []
+
+    if len(entities) != 0:
+        client.put_multi(entities)
+
+    return frequency
+
+
+def main_bench():
+
+    parser = argparse.ArgumentParser(description="Full-text search benchmark.")
+    parser.add_argument("--books", type=int, default=100000)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    client = storage.get_client()
+    vocabulary = make_words(args.vocabulary, "word")
+
+    seed_start = time.time()
+    frequency = seed(client, args.books, vocabulary, make_words(2000, "author"), make_words(500, "artist"), args.seed)
+    seed_seconds = time.time() - seed_start
+
+    ranked = [word for word, count in frequency.most_common() if word.startswith("word")]
+
+    # The kinds of query to time, each with the words to search for.
+    queries = {
+        "common": [ranked[0], ranked[1], ranked[2]],
+        "medium": ranked[100:103],
+        "rare": ranked[-3:],
+        "two_common": [ranked[0] + " " + ranked[1], ranked[1] + " " + ranked[2]],
+        "author": ["author7", "author1999"],
+    }
+
+    test_client = main.app.test_client()
+    headers = {"Accept": "application/json"}
+    report = {"config": {"backend": storage.backend, "books": args.books, "vocabulary": args.vocabulary,
+                         "rounds": args.rounds, "limit": args.limit, "seed": args.seed},
+              "seed_seconds": round(seed_seconds, 3),
+              "queries": {}}
+
+    for name, texts in queries.items():
+
+        latencies = []
+        rpcs = []
+        counts = []
+        truncated = 0
+
+        for round_number in range(args.rounds):
+
+            text = texts[round_number % len(texts)]
+
+            start = time.perf_counter()
+            response = test_client.get("/books/search", query_string={"q": text, "limit": args.limit},
+                                       headers=headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+            rpcs.append(get_rpc_count(response))
+            data = json.loads(response.data)
+            counts.append(data["count"])
+            truncated += data["truncated"]
+
+        report["queries"][name] = {"examples": texts, "p50_ms": percentile(latencies, 0.5),
+                                   "p95_ms": percentile(latencies, 0.95), "rpcs_per_request": max(rpcs),
+                                   "max_matches": max(counts), "truncated_rounds": truncated}
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main_bench()
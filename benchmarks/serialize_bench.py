@@ -0,0 +1,156 @@
+# Benchmark for turning pages of entities into response bodies.
+#
+# Builds pages of books and libraries (each library listing --books-per-library books) and times two ways of
+# serializing them:
+#   legacy      - what the helpers did before serializers.py: add id and self links to each entity in place,
+#                 building every link from request.url_root with get_self.
+#   serializers - serializers.book and serializers.library, which build new dicts from per-request link prefixes.
+# Each is timed on its own and followed by json.dumps, which is what the views do next.  Every round starts from
+# freshly built entities, since the legacy code changes the ones it's given.  Prints entities per second as JSON.
+#
+#   python benchmarks/serialize_bench.py --page 1000 --rounds 50
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask, request
+from google.cloud import datastore
+import constants
+import helper
+import serializers
+
+project = "serialize-bench"
+
+
+def make_books(count):
+
+    books = []
+
+    for i in range(1, count + 1):
+
+        book = datastore.entity.Entity(key=datastore.key.Key(constants.books, i, project=project))
+        book.update({"title": "Title " + str(i), "author": "Author", "illustrator": "Illustrator",
+                     "library": {"id": str(i % 50 + 1)} if i % 2 == 0 else None})
+        books.append(book)
+
+    return books
+
+
+def make_libraries(count, books_per_library):
+
+    libraries = []
+
+    for i in range(1, count + 1):
+
+        library = datastore.entity.Entity(key=datastore.key.Key(constants.libraries, i, project=project))
+        library.update({"name": "Library " + str(i), "street_address": str(i) + " Main Street", "county": "County",
+                        "state": "State", "librarian": {"id": 1},
+                        "books": [{"id": str(i * books_per_library + j)} for j in range(books_per_library)]})
+        libraries.append(library)
+
+    return libraries
+
+
+def legacy_books(books):
+
+    for book in books:
+
+        book["id"] = str(book.key.id)
+        book["self"] = helper.get_self(request, constants.books, book["id"])
+
+        if book["library"] is not None:
+            book["library"]["self"] = helper.get_self(request, constants.libraries, book["library"]["id"])
+
+    return books
+
+
+def legacy_libraries(libraries):
+
+    for library in libraries:
+
+        library["id"] = str(library.key.id)
+        library["self"] = helper.get_self(request, constants.libraries, library["id"])
+
+        for book in library["books"]:
+            book["self"] = helper.get_self(request, constants.books, book["id"])
+
+    return libraries
+
+
+def new_books(books):
+
+    links = serializers.get_links(request)
+
+    return [serializers.book(links, book) for book in books]
+
+
+def new_libraries(libraries):
+
+    links = serializers.get_links(request)
+
+    return [serializers.library(links, library) for library in libraries]
+
+
+# Runs serialize over a fresh page from make_page each round.  Returns entities per second for serializing alone
+# and for serializing plus json.dumps.
+def measure(app, make_page, serialize, rounds):
+
+    serialize_seconds = 0.0
+    total_seconds = 0.0
+    entities = 0
+
+    for _ in range(rounds):
+
+        page = make_page()
+
+        # A new request each round, so the link prefixes are worked out inside the timed part too.
+        with app.test_request_context("/", base_url="https://api.example.com"):
+
+            start = time.perf_counter()
+            output = serialize(page)
+            serialized = time.perf_counter()
+            json.dumps(output)
+            dumped = time.perf_counter()
+
+        serialize_seconds += serialized - start
+        total_seconds += dumped - start
+        entities += len(page)
+
+    return {"serialize_per_second": round(entities / serialize_seconds),
+            "with_json_per_second": round(entities / total_seconds)}
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Entity serialization benchmark.")
+    parser.add_argument("--page", type=int, default=1000, help="Entities per page.")
+    parser.add_argument("--books-per-library", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+
+    def book_page():
+        return make_books(args.page)
+
+    def library_page():
+        return make_libraries(args.page, args.books_per_library)
+
+    report = {
+        "config": {"page": args.page, "books_per_library": args.books_per_library, "rounds": args.rounds},
+        "books": {"legacy": measure(app, book_page, legacy_books, args.rounds),
+                  "serializers": measure(app, book_page, new_books, args.rounds)},
+        "libraries": {"legacy": measure(app, library_page, legacy_libraries, args.rounds),
+                      "serializers": measure(app, library_page, new_libraries, args.rounds)},
+    }
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Stress test for putting books in libraries and taking them out again.
+#
+# N writers share one pool of books.  Each writer owns a library and keeps trying to check random books into it and
+# back out.  When they finish, every book must be in at most one library, and each library's list of books must
+# match the books that point back at it.  Prints the throughput and how each operation ended.
+#
+# Runs against the Datastore emulator:
+#   gcloud beta emulators datastore start
+#   $(gcloud beta emulators datastore env-init)
+#   python benchmarks/stress_checkout.py --writers 16 --books 50 --operations 200
+#
+# or against the in-memory backend with STORAGE_BACKEND=memory.
+
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask, request
+from google.api_core import exceptions
+from google.cloud import datastore
+import constants
+import helper
+import storage
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Concurrent check-in/check-out stress test.")
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--books", type=int, default=20)
+    parser.add_argument("--operations", type=int, default=100, help="Operations per writer.")
+    parser.add_argument("--project", default=os.environ.get("DATASTORE_PROJECT_ID", "stress-test"))
+    args = parser.parse_args()
+
+    if storage.backend == storage.memory_backend:
+
+        client = storage.get_client()
+
+    elif "DATASTORE_EMULATOR_HOST" in os.environ:
+
+        client = datastore.Client(project=args.project)
+
+    else:
+
+        sys.exit("Set DATASTORE_EMULATOR_HOST so this runs against the emulator, not a live project.")
+    app = Flask(__name__)
+
+    subs = []
+    library_ids = []
+    book_ids = []
+
+    run_id = str(int(time.time()))
+
+    with app.test_request_context("/", json={"name": "Stress", "street_address": "1 Main", "county": "Test",
+                                               "state": "Test", "title": "Stress", "author": "Test"}):
+
+        for i in range(args.writers):
+
+            sub = "stress-" + run_id + "-" + str(i)
+            helper.create_user(client, request, {"unique_id": sub, "email": sub + "@example.com"})
+            library, status = helper.create_library(client, request, sub)
+
+            subs.append(sub)
+            library_ids.append(library["id"])
+
+        for i in range(args.books):
+
+            book, status = helper.create_book(client, request)
+            book_ids.append(book["id"])
+
+    outcomes = collections.Counter()
+    outcomes_lock = threading.Lock()
+
+    def writer(index):
+
+        sub = subs[index]
+        library_id = library_ids[index]
+
+        for _ in range(args.operations):
+
+            book_id = random.choice(book_ids)
+
+            with app.test_request_context("/"):
+
+                try:
+                    if random.random() < 0.5:
+                        message, status = helper.put_book_in_library(client, request, library_id, book_id, sub)
+                        outcome = "put " + str(status)
+                    else:
+                        message, status = helper.remove_book_from_library(client, request, library_id, book_id,
+                                                                          sub)
+                        outcome = "remove " + str(status)
+
+                except (exceptions.Aborted, exceptions.Conflict):
+
+                    outcome = "gave up after retries"
+
+            with outcomes_lock:
+                outcomes[outcome] += 1
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+
+    start = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - start
+    total = args.writers * args.operations
+
+    print("writers: %d  books: %d  operations: %d" % (args.writers, args.books, total))
+    print("elapsed: %.2fs  throughput: %.1f ops/s" % (elapsed, total / elapsed))
+
+    for outcome, count in sorted(outcomes.items()):
+        print("  %-24s %d" % (outcome, count))
+
+    # Check the invariants.
+    libraries = helper.get_entities(client, [client.key(constants.libraries, int(i)) for i in library_ids])
+    books = helper.get_entities(client, [client.key(constants.books, int(i)) for i in book_ids])
+
+    shelved = {}
+    errors = []
+
+    for library in libraries:
+
+        for entry in library["books"]:
+
+            if entry["id"] in shelved:
+                errors.append("book %s is listed by libraries %s and %s" % (entry["id"], shelved[entry["id"]],
+                                                                           library.key.id))
+
+            shelved[entry["id"]] = str(library.key.id)
+
+    for book in books:
+
+        book_id = str(book.key.id)
+        library_id = book["library"]["id"] if book["library"] is not None else None
+
+        if shelved.get(book_id) != library_id:
+            errors.append("book %s points at library %s but is listed by %s" % (book_id, library_id,
+                                                                               shelved.get(book_id)))
+
+    if errors:
+
+        print("FAILED: %d inconsistencies" % len(errors))
+
+        for error in errors[:20]:
+            print("  " + error)
+
+        sys.exit(1)
+
+    print("OK: every book is in at most one library and every library's list matches its books")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,20 @@
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-from json2html import *
 import json
+import batch
 import constants
+import etags
 import helper
+import storage
+import streaming
 import verify_helper
 
-client = datastore.Client()
+client = storage.get_client()
 
 bp = Blueprint('book', __name__, url_prefix='/books')
 
+# The prefix above would turn /books:batch into /books/:batch, so the batch route has a blueprint of its own.
+batch_bp = Blueprint('book_batch', __name__)
+
 # The bits of code on making responses comes straight from the lectures on advanced api
 
 
@@ -25,7 +30,7 @@ def books_get_post():
         return res
 
     # Test that the user is requesting JSON and that the user is registered with our application.
-    if helper.is_requesting_json(request) is False:
+    if helper.is_requesting_json(request) is False and streaming.is_ndjson(request) is False:
         return {"Error": constants.error_406_json}, 406
 
     if request.method == 'POST':
@@ -35,6 +40,11 @@ def books_get_post():
 
     elif request.method == 'GET':
 
+        if streaming.is_requested(request):
+
+            books, status = helper.get_book_stream(client, request)
+            return streaming.respond(request, books, status)
+
         # Now have to add pagination
         # { next: link to next page
         #   count: 3
@@ -43,6 +53,44 @@ def books_get_post():
         return json.dumps(books), status
 
 
+# Creates, patches and deletes many books in one request.  See batch.py for the body.
+@batch_bp.route('/books:batch', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
+def books_batch():
+
+    if request.method != "POST":
+
+        res = make_response(json.dumps({"Error": constants.error_405_bad_method}))
+        res.mime_type = "application/json"
+        res.status_code = 405
+        res.headers.set("Allow", ["POST"])
+        return res
+
+    if helper.is_requesting_json(request) is False:
+        return {"Error": constants.error_406_json}, 406
+
+    results, status = batch.run_batch(client, request)
+    return json.dumps(results), status
+
+
+# Ranked full-text search over the books' titles, authors and illustrators.  See helper.search_books.
+@bp.route('/search', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
+def books_search():
+
+    if request.method != "GET":
+
+        res = make_response(json.dumps({"Error": constants.error_405_bad_method}))
+        res.mime_type = "application/json"
+        res.status_code = 405
+        res.headers.set("Allow", ["GET"])
+        return res
+
+    if helper.is_requesting_json(request) is False:
+        return {"Error": constants.error_406_json}, 406
+
+    books, status = helper.search_books(client, request)
+    return json.dumps(books), status
+
+
 @bp.route('/<id>', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
 def books_get_put_patch_delete(id):
 
@@ -56,23 +104,23 @@ def books_get_put_patch_delete(id):
 
             book, status = helper.get_book_with_status(client, request, id)
 
-            return json.dumps(book), status
+            return etags.respond(request, book, status)
 
         elif request.method == 'PUT':
 
             book, status = helper.put_book(client, request, id)
 
-            return json.dumps(book), status
+            return etags.respond(request, book, status)
 
         elif request.method == 'PATCH':
 
             book, status = helper.patch_book(client, request, id)
 
-            return json.dumps(book), status
+            return etags.respond(request, book, status)
 
     elif request.method == 'DELETE':
 
-        payload, status = helper.delete_book(client, id)
+        payload, status = helper.delete_book(client, request, id)
 
         if status != 204:
 
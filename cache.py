@@ -0,0 +1,101 @@
+# Small in-process caches used to keep repeated work (token verification, user lookups, entity reads) off the
+# request path.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# A thread safe LRU cache where every entry carries its own expiry time.  Entries are dropped once they expire or,
+# when the cache grows past max_size, in least recently used order.  Hits, misses and evictions are counted so
+# they can be reported.
+class TTLCache:
+
+    def __init__(self, max_size, default_ttl=None, clock=time.time):
+
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the cached value for key, or default if it is missing or expired.
+    def get(self, key, default=None):
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is not None:
+
+                value, expires_at = entry
+
+                if expires_at is None or expires_at > self.clock():
+
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    # Stores value under key.  The entry expires ttl seconds from now, at the absolute time expires_at, or after
+    # default_ttl if neither is given.  An entry with no expiry lives until it is evicted.
+    def set(self, key, value, ttl=None, expires_at=None):
+
+        if expires_at is None:
+
+            if ttl is None:
+                ttl = self.default_ttl
+
+            if ttl is not None:
+                expires_at = self.clock() + ttl
+
+        with self._lock:
+
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Removes key from the cache.  Returns the value that was stored, or None.
+    def pop(self, key):
+
+        with self._lock:
+
+            entry = self._entries.pop(key, None)
+
+        if entry is None:
+            return None
+
+        return entry[0]
+
+    def clear(self):
+
+        with self._lock:
+
+            self._entries.clear()
+
+    def stats(self):
+
+        with self._lock:
+
+            return {"size": len(self._entries),
+                    "max_size": self.max_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def __len__(self):
+
+        return len(self._entries)
@@ -0,0 +1,99 @@
+# Runs independent Datastore lookups for one request at the same time.
+#
+# Flask 1.1 has no async views, so the lookups run on a small shared thread pool instead.  Each one runs with a copy
+# of the request context, so helpers can still use request and flask.g.  Every thread gets its own g, though, so the
+# RPCs a pooled lookup makes are added back to the request's totals when it finishes.  Work started from inside the
+# pool runs in the calling thread, which keeps the pool from waiting on itself.
+#
+# The pool has lookup_threads threads shared by every request, so a burst of requests can't open an unbounded number
+# of Datastore connections.  A lookup only goes to the pool if a thread is free to start it right away.  Otherwise it
+# runs in the request's own thread, so a busy pool never leaves a lookup queued behind other requests' work.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import copy_current_request_context, g, has_request_context
+import constants
+import metrics
+
+executor = ThreadPoolExecutor(max_workers=constants.lookup_threads, thread_name_prefix="lookup")
+
+# One slot per thread, held from when a lookup is handed to the pool until it finishes.
+slots = threading.BoundedSemaphore(constants.lookup_threads)
+
+local = threading.local()
+
+
+def in_pool():
+
+    return getattr(local, "in_pool", False)
+
+
+# Starts func on the pool and returns its future, or returns None without starting it if every thread is busy.
+def submit(func):
+
+    if not slots.acquire(blocking=False):
+
+        return None
+
+    if has_request_context():
+
+        func = copy_current_request_context(func)
+
+    def run():
+
+        local.in_pool = True
+
+        try:
+            result = func()
+
+        finally:
+            local.in_pool = False
+            slots.release()
+
+        return result
+
+    return executor.submit(run)
+
+
+# Calls every function and returns their results in order.  The first runs in this thread and the rest on the pool,
+# all at the same time, so this takes about as long as the slowest of them.  Functions the pool has no free thread
+# for run in this thread after the first, one after the other.
+def run_all(*funcs):
+
+    if in_pool() or len(funcs) < 2:
+
+        return [func() for func in funcs]
+
+    futures = [submit(with_rpc_stats(func)) for func in funcs[1:]]
+    results = [funcs[0]()]
+
+    for func, future in zip(funcs[1:], futures):
+
+        if future is None:
+
+            results.append(func())
+            continue
+
+        result, stats = future.result()
+        metrics.add_rpc_stats(stats)
+        results.append(result)
+
+    return results
+
+
+# Returns func(item) for every item, run at the same time like run_all.
+def map_all(func, items):
+
+    return run_all(*[(lambda item=item: func(item)) for item in items])
+
+
+# Wraps func to also return the RPCs it recorded in its thread's g.
+def with_rpc_stats(func):
+
+    def run():
+
+        result = func()
+
+        return result, g.get("rpc_stats", {}) if has_request_context() else {}
+
+    return run
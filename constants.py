@@ -1,8 +1,17 @@
 users = "users"
 books = "books"
 libraries = "libraries"
-states = "states"
 
+error_400_page = "The limit, offset or cursor for this page is invalid."
+error_400_book = "A book needs a title and an author, and its title, author and illustrator must be text."
+error_400_batch = "The batch must be a JSON array, or NDJSON, of at most 10000 items."
+error_400_batch_item = \
+    "Each item needs an op of create, patch or delete, the book to create or patch, and the id to patch or delete."
+error_400_shelve = "The body must have shelve and/or unshelve lists of book ids, with fewer than 500 ids in all."
+error_400_book_query = ("Sort must be title, -title, author or -author, shelved must be true or false, and a "
+                        "title_prefix can only be sorted by title.")
+error_400_search = "The q parameter must have between 1 and 10 words."
+error_400_user_view = "The view must be full or summary, and only libraries can be expanded."
 error_401_bad_jwt = "The JWT is missing or invalid."
 error_403_no_access = "You do not have access to that resource."
 error_403_put = \
@@ -14,3 +23,61 @@ error_404_put = "The specified library and/or book don't exist."
 error_404_delete = "No book with this book_id is at the library with this library_id."
 error_405_bad_method = "This is not an accepted method."
 error_406_json = "The response body can only be returned in JSON."
+error_409_shelved = "This book is already in another library."
+error_412_etag = "The resource has changed since the ETag in If-Match was issued."
+
+# Google's public keys for checking the signature on ID tokens.
+google_certs_url = "https://www.googleapis.com/oauth2/v1/certs"
+google_issuers = ["accounts.google.com", "https://accounts.google.com"]
+
+# OAuth states are good for this many seconds.  Used ones are remembered, up to this many at a time.
+state_ttl = 600
+used_state_cache_size = 100000
+
+# Verified ID tokens are kept until they expire, up to this many at a time.
+token_cache_size = 10000
+
+# Users' ids and owned library ids are cached across requests for this many seconds, up to this many users.
+principal_cache_size = 10000
+principal_cache_ttl = 60
+
+# Books and libraries read by id are cached for this many seconds, up to this many per instance.
+entity_cache_size = 10000
+entity_cache_ttl = 60
+
+# Running entity totals are kept in sharded counters of this kind.
+counters = "counters"
+counter_shards = 20
+
+# Pages hold default_page_limit items unless the limit query parameter asks for more, up to max_page_limit.
+default_page_limit = 5
+max_page_limit = 100
+
+# The most mutations Datastore accepts in one commit.  Batched writes are split into chunks of this size.
+batch_size = 500
+
+# The most items POST /books:batch takes in one request.
+max_batch_items = 10000
+
+# Transactions that hit contention are tried this many times, backing off from transaction_backoff seconds.
+transaction_retries = 5
+transaction_backoff = 0.05
+
+# Threads shared by all requests for running a request's independent Datastore lookups at the same time.
+lookup_threads = 16
+
+# Requests slower than this many milliseconds are logged.  Override with SLOW_REQUEST_MS.
+slow_request_ms = 500
+
+# Histogram buckets for request latency in seconds and for Datastore RPCs per request.
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+rpc_count_buckets = [0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000]
+
+# Entities fetched per query when a collection is streamed instead of paged.
+stream_page_size = 500
+
+# Each book is searchable by up to max_search_terms distinct words.  A search has at most max_search_query_terms
+# words and ranks at most search_candidate_limit matching books.
+max_search_terms = 100
+max_search_query_terms = 10
+search_candidate_limit = 1000
@@ -0,0 +1,74 @@
+# Sharded counters that keep a running total of the entities of a kind, so pages can report a count without reading
+# the entities themselves.  Each counter is split across counter_shards entities to spread out write contention.
+
+import random
+from google.cloud import datastore
+import constants
+import transactions
+
+
+def get_shard_keys(dsClient, kindOfEntity):
+
+    return [dsClient.key(constants.counters, kindOfEntity + "-" + str(i)) for i in range(constants.counter_shards)]
+
+
+# Adds delta to the counter for kindOfEntity.  A random shard takes the write.
+def increment(dsClient, kindOfEntity, delta=1):
+
+    shard_key = random.choice(get_shard_keys(dsClient, kindOfEntity))
+
+    def add_to_shard():
+
+        shard = dsClient.get(key=shard_key)
+
+        if shard is None:
+
+            shard = datastore.entity.Entity(key=shard_key)
+            shard["count"] = 0
+
+        shard["count"] += delta
+        dsClient.put(shard)
+
+    transactions.run_in_transaction(dsClient, add_to_shard)
+
+
+# Returns the number of entities of kindOfEntity.  The first time a counter is read, the entities that existed
+# before it was kept are counted once with a keys-only query and stored as its base.
+def get_count(dsClient, kindOfEntity):
+
+    base_key = dsClient.key(constants.counters, kindOfEntity + "-base")
+
+    shards = dsClient.get_multi([base_key] + get_shard_keys(dsClient, kindOfEntity))
+
+    for shard in shards:
+
+        if shard.key == base_key:
+
+            return sum(shard["count"] for shard in shards)
+
+    # Increments that landed before the base was written are already in the shards, so the base only holds the rest.
+    shard_total = sum(shard["count"] for shard in shards)
+
+    base = datastore.entity.Entity(key=base_key)
+    base["count"] = count_entities(dsClient, kindOfEntity) - shard_total
+    dsClient.put(base)
+
+    return base["count"] + shard_total
+
+
+# Counts the entities of kindOfEntity, optionally filtered, without fetching anything but their keys.  filters is a
+# list of (property, operator, value) filters to add to the one given by filter_criteria and filter_value.
+def count_entities(dsClient, kindOfEntity, filter_criteria=None, filter_value=None, filters=()):
+
+    query = dsClient.query(kind=kindOfEntity)
+    query.keys_only()
+
+    if filter_criteria is not None and filter_value is not None:
+
+        query.add_filter(filter_criteria, "=", filter_value)
+
+    for property_name, operator, value in filters:
+
+        query.add_filter(property_name, operator, value)
+
+    return sum(1 for _ in query.fetch())
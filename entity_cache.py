@@ -0,0 +1,213 @@
+# Read-through cache for single book and library lookups.
+#
+# get() returns the entity from the cache when it can and otherwise reads it from Datastore and caches it.  Every
+# helper that writes a book or library calls invalidate() with its key once the write has committed.
+#
+# Invalidation is versioned.  Each key has a version, cached entities are stored under the version that was current
+# when the read started, and invalidate() gives the key a new one.  A read that raced with a write can only store what
+# it read under the old version, where nothing will look for it again.  A version is never used twice: a key whose
+# version has been evicted or has expired gets a new one, not its first one back, so entries stored under a forgotten
+# version can't be found again either.
+#
+# ENTITY_CACHE_BACKEND picks where entries live:
+#   local (default) - a cache.TTLCache in this process, bounded by entity_cache_size with LRU eviction.  Other
+#                     instances don't see this one's invalidations, so they can serve an entity up to
+#                     entity_cache_ttl seconds old.
+#   redis           - a Redis server, or anything that speaks its protocol, at REDIS_URL.  Every instance shares
+#                     the entries and the versions.  The server's maxmemory policy bounds its size.
+#   none            - no caching.
+# Entries expire after entity_cache_ttl seconds with either backend.
+
+import itertools
+import json
+import os
+import threading
+import uuid
+from google.cloud import datastore
+import cache
+import constants
+
+local_backend = "local"
+redis_backend = "redis"
+no_backend = "none"
+
+# Versions outlive the entries stored under them, so a version is only ever forgotten once its entries are gone.
+version_ttl = constants.entity_cache_ttl * 10
+
+
+def get_name(key):
+
+    return "entity:" + "/".join(str(part) for part in key.flat_path)
+
+
+# Keeps entries in this process.  Entities aren't copied: whoever reads through the cache gets the cached entity
+# itself, and serializers.py only ever builds new dicts from it.
+class LocalBackend:
+
+    def __init__(self):
+
+        self.entries = cache.TTLCache(constants.entity_cache_size, default_ttl=constants.entity_cache_ttl)
+        self.versions = cache.TTLCache(constants.entity_cache_size * 4, default_ttl=version_ttl)
+
+        # Versions count up across every key, so one this process has handed out is never handed out again.
+        self.next_version = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def get_version(self, name):
+
+        with self.lock:
+
+            version = self.versions.get(name)
+
+            if version is None:
+
+                version = next(self.next_version)
+                self.versions.set(name, version)
+
+            return version
+
+    def bump_versions(self, names):
+
+        with self.lock:
+
+            for name in names:
+
+                self.versions.set(name, next(self.next_version))
+
+    def get(self, name, version, dsClient):
+
+        return self.entries.get((name, version))
+
+    def set(self, name, version, entity):
+
+        self.entries.set((name, version), entity)
+
+    def stats(self):
+
+        return self.entries.stats()
+
+
+# Keeps entries in Redis as JSON, so any instance can rebuild them.  The redis package is only needed when this
+# backend is used.
+class RedisBackend:
+
+    def __init__(self, url):
+
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    # Versions are random, so a key whose version expired or was evicted can't land on an old one again.
+    def get_version(self, name):
+
+        # Only sets the version if the key doesn't have one, so a version another instance just set is kept.  Both
+        # commands go in one round trip.
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.set(name + ":version", uuid.uuid4().hex, ex=version_ttl, nx=True)
+        pipeline.get(name + ":version")
+        version = pipeline.execute()[1]
+
+        # Expired in between.  Nothing can have been stored under a version no one has seen yet.
+        if version is None:
+            return uuid.uuid4().hex
+
+        return version.decode("ascii")
+
+    def bump_versions(self, names):
+
+        pipeline = self.redis.pipeline(transaction=False)
+
+        for name in names:
+
+            pipeline.set(name + ":version", uuid.uuid4().hex, ex=version_ttl)
+
+        pipeline.execute()
+
+    def get(self, name, version, dsClient):
+
+        record = self.redis.get(name + ":" + str(version))
+
+        if record is None:
+
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        record = json.loads(record)
+
+        entity = datastore.entity.Entity(key=dsClient.key(*record["path"]))
+        entity.update(record["properties"])
+
+        return entity
+
+    def set(self, name, version, entity):
+
+        record = json.dumps({"path": list(entity.key.flat_path), "properties": dict(entity)})
+        self.redis.set(name + ":" + str(version), record, ex=constants.entity_cache_ttl)
+
+    def stats(self):
+
+        return {"hits": self.hits, "misses": self.misses, "size": self.redis.dbsize()}
+
+
+def get_backend(name):
+
+    if name == redis_backend:
+        return RedisBackend(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+
+    if name == no_backend:
+        return None
+
+    return LocalBackend()
+
+
+backend = get_backend(os.environ.get("ENTITY_CACHE_BACKEND", local_backend))
+
+
+# Returns the entity with this key, or None if there isn't one.  Not for use inside a transaction, which has to read
+# from Datastore itself.
+def get(dsClient, key):
+
+    if backend is None:
+
+        return dsClient.get(key=key)
+
+    name = get_name(key)
+
+    # The version is read first, so anything this read stores lands under a version that's already out of date if a
+    # write commits while it's in progress.
+    version = backend.get_version(name)
+    entity = backend.get(name, version, dsClient)
+
+    if entity is not None:
+
+        return entity
+
+    entity = dsClient.get(key=key)
+
+    if entity is not None:
+
+        backend.set(name, version, entity)
+
+    return entity
+
+
+# Drops the cached entities with these keys.  Call it after the write that changed them has committed.
+def invalidate(keys):
+
+    if backend is None:
+
+        return
+
+    backend.bump_versions({get_name(key) for key in keys})
+
+
+def stats():
+
+    if backend is None:
+
+        return {"hits": 0, "misses": 0, "size": 0}
+
+    return backend.stats()
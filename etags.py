@@ -0,0 +1,59 @@
+# Strong ETags for books and libraries.
+#
+# An entity's ETag is a hash of its key and everything stored on it, so it changes whenever a write changes the
+# entity and stays the same otherwise.  The helpers that read or write a single entity call set_etag before they add
+# ids and self links, and respond then sends it back:
+#   - GET with an If-None-Match that matches is answered with 304 Not Modified and no body.
+#   - PUT, PATCH and DELETE with an If-Match that doesn't match the stored entity are refused with 412 Precondition
+#     Failed.  The helpers check this in the same transaction as the write, so a client can't overwrite a change it
+#     hasn't seen.
+
+import hashlib
+import json
+from flask import g, make_response
+
+
+def get_etag(entity):
+
+    content = json.dumps({"kind": entity.key.kind, "id": entity.key.id, "properties": dict(entity)},
+                         sort_keys=True, default=str)
+
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]
+
+
+# Remembers the entity's ETag for respond.  Call it with the entity as stored, before ids and links are added.
+def set_etag(entity):
+
+    g.etag = get_etag(entity)
+
+
+# Returns false if the request has an If-Match header that the stored entity doesn't match.  Returns true, otherwise.
+def matches(request, entity):
+
+    if not request.if_match:
+
+        return True
+
+    # contains is also true for If-Match: *
+    return request.if_match.contains(get_etag(entity))
+
+
+# Builds the JSON response for payload and status, with the ETag set_etag remembered if there is one.  A GET whose
+# If-None-Match already has that ETag gets an empty 304 instead.
+def respond(request, payload, status):
+
+    etag = g.get("etag") if status in [200, 201] else None
+
+    if etag is not None and request.method in ["GET", "HEAD"] and request.if_none_match.contains_weak(etag):
+
+        res = make_response("", 304)
+
+    else:
+
+        res = make_response(json.dumps(payload), status)
+
+    if etag is not None:
+
+        res.set_etag(etag)
+
+    return res
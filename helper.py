@@ -3,7 +3,19 @@
 # List of helper function to make my life easier.
 
 from google.cloud import datastore
+from google.api_core import exceptions
+from urllib.parse import urlencode
 import constants
+import concurrency
+import counters
+import entity_cache
+import etags
+import membership
+import principal
+import queries
+import search
+import serializers
+import transactions
 
 
 def fill_entity(content, listOfKeys):
@@ -34,9 +46,8 @@ def has_all_keys(content, listOfKeysExpected):
 
 # Creates a new entity of the type kindOfEntity.  Input MUST be validated before calling this function.
 # No error checking performed.
-# Returns the new entity as a json object along with a 201 created code on success.
-# The returned json entity will also include the entity's id and self link.
-def create_entity(dsClient, request, content, keysExpected, kindOfEntity):
+# Returns the new entity along with a 201 created code on success.
+def create_entity(dsClient, content, keysExpected, kindOfEntity):
 
     new_entity = datastore.entity.Entity(key=dsClient.key(kindOfEntity))
 
@@ -45,21 +56,27 @@ def create_entity(dsClient, request, content, keysExpected, kindOfEntity):
     new_entity.update(newInfo)
     dsClient.put(new_entity)
 
-    new_entity["id"] = str(new_entity.key.id)
-    new_entity["self"] = get_self(request, kindOfEntity, new_entity["id"])
-
     return new_entity, 201
 
 
-# Creates a user entity.  Returns the new entity as a json object along with a 201 created code on success.
-# The returned json entity will also include the entity's id and self link.
+# Creates a user entity.  Returns the new user as a json object along with a 201 created code on success.
+# The returned json user will also include the user's id.
 def create_user(dsClient, request, content):
 
-    keysExpected = ["unique_id", "email", "libraries"]
+    keysExpected = ["unique_id", "email"]
+
+    if not membership.is_indexed():
+
+        keysExpected.append("libraries")
+        content["libraries"] = []
+
+    user, status = create_entity(dsClient, content, keysExpected, constants.users)
+
+    counters.increment(dsClient, constants.users)
 
-    content["libraries"] = []
+    principal.remember(principal.Principal(dsClient, user["unique_id"], user.key.id, []))
 
-    return create_entity(dsClient, request, content, keysExpected, constants.users)
+    return serializers.user(serializers.get_links(request), user), status
 
 
 # Creates a library entity.  Returns the new entity as a json object along with a 201 created code on success.
@@ -77,25 +94,30 @@ def create_library(dsClient, request, owner_sub):
 
     content = request.get_json()
 
-    keysExpected = ["name", "street_address", "county", "state", "librarian", "books"]
+    keysExpected = ["name", "street_address", "county", "state", "librarian"]
 
     # The current user/librarian will be given ownership of this library.
-    query = dsClient.query(kind=constants.users)
-    query.add_filter("unique_id", "=", owner_sub)
+    owner = principal.get_principal(dsClient, owner_sub)
 
-    librarian = list(query.fetch())[0]
+    content["librarian"] = {"id": owner.user_id}
 
-    content["librarian"] = {"id": librarian.key.id}
-    content["books"] = []
+    if not membership.is_indexed():
 
-    new_library, status = create_entity(dsClient, request, content, keysExpected, constants.libraries)
+        keysExpected.append("books")
+        content["books"] = []
+
+    new_library, status = create_entity(dsClient, content, keysExpected, constants.libraries)
 
     # new_library["librarian"]["self"] = get_self(request, constants.users, new_library["librarian"]["id"])
 
-    librarian["libraries"].append({"id": new_library["id"]})
-    dsClient.put(librarian)
+    # The user entity only lists its libraries in the embedded membership mode.  In the indexed mode it isn't read.
+    if not membership.is_indexed() and membership.add_library(owner.user, new_library.key.id):
+
+        dsClient.put(owner.user)
 
-    return new_library, status
+    owner.add_library(new_library.key.id)
+
+    return serializers.library(serializers.get_links(request), new_library), status
 
 
 # Creates a user entity.  Returns the new entity as a json object along with a 201 created code on success.
@@ -111,32 +133,101 @@ def create_book(dsClient, request):
 
     content = request.get_json()
 
-    keysExpected = ["title", "author", "illustrator", "library"]
+    if is_valid_book(content, ["title", "author"]) is False:
+
+        return {"Error": constants.error_400_book}, 400
+
+    book, status = create_entity(dsClient, get_new_book(content), book_attributes, constants.books)
+
+    counters.increment(dsClient, constants.books)
+
+    return serializers.book(serializers.get_links(request), book), status
+
+
+# Returns true if content is a valid book, or part of one.  Every key in keysRequired must be present, and the title,
+# author and illustrator must be text if they are given.  The illustrator may also be null.
+def is_valid_book(content, keysRequired):
+
+    if not isinstance(content, dict):
+
+        return False
+
+    if any(key not in content for key in keysRequired):
+
+        return False
+
+    for key in ["title", "author", "illustrator"]:
+
+        if key in content and not isinstance(content[key], str):
+
+            if key != "illustrator" or content[key] is not None:
+
+                return False
+
+    return True
+
+
+# Returns the attributes of a new book made from valid content.  The illustrator is optional and a new book is never
+# in a library.
+def get_new_book(content):
+
+    book = get_book_changes(content, ["title", "author"])
+    book["illustrator"] = content.get("illustrator")
+    set_library(book, None)
+    search.index_book(book)
+
+    return book
+
+
+# Puts the book in the library with library_id, or takes it out of its library if library_id is None.  Every change
+# to a book's library goes through here, so shelved, the indexed flag GET /books?shelved= filters on, always agrees
+# with it.
+def set_library(book, library_id):
+
+    if library_id is None:
+
+        book["library"] = None
+
+    else:
+
+        book["library"] = {"id": str(library_id)}
+
+    book["shelved"] = library_id is not None
+
+
+# Returns the attributes in listOfKeys from valid book content.  A changed title comes with its title_lower, the
+# lowercase copy that GET /books sorts on and matches title_prefix against.
+def get_book_changes(content, listOfKeys):
+
+    changes = fill_entity(content, listOfKeys)
 
-    if "illustrator" not in content.keys():
+    if "title" in changes:
 
-        content["illustrator"] = None
+        changes["title_lower"] = changes["title"].lower()
 
-    content["library"] = None
+    return changes
 
-    return create_entity(dsClient, request, content, keysExpected, constants.books)
 
+# Every attribute a book entity has.
+book_attributes = ["title", "title_lower", "author", "illustrator", "library", "shelved"] + search.index_fields
 
-# Returns the entity of type kindOfEntity with the provided id and self link.
+
+# Returns the entity of type kindOfEntity with the provided id, through the entity cache.  The entity may be shared
+# with other requests, so it must not be changed.
 # Returns status code 404 if the entity is not found.
 # Otherwise, returns the Entity along with a status code.
-def get_entity_with_info(dsClient, request, kindOfEntity, id):
+def get_entity_with_status(dsClient, kindOfEntity, id):
 
     entity_key = dsClient.key(kindOfEntity, int(id))
-    entity = dsClient.get(key=entity_key)
+    entity = entity_cache.get(dsClient, entity_key)
 
     # https://realpython.com/null-in-python/
     if entity is None:
         # We couldn't find an entity of that type with that id.
         return None, 404
 
-    entity["id"] = str(entity.key.id)
-    entity["self"] = get_self(request, kindOfEntity, entity["id"])
+    etags.set_etag(entity)
+
     return entity, 200
 
 
@@ -145,41 +236,62 @@ def get_entity_with_info(dsClient, request, kindOfEntity, id):
 # Returns an error message and 404 status if the entity is not found.
 def get_library_with_status(dsClient, request, id, sub):
 
-    library, status = get_entity_with_info(dsClient, request, constants.libraries, id)
+    library, status = get_entity_with_status(dsClient, constants.libraries, id)
 
     if status == 404:
         # We couldn't find a library with that id.
         return {"Error": constants.error_404_no_library}, 404
 
-    if user_owns_library(dsClient, id, sub) is False:
+    if is_librarian(dsClient, library, sub) is False:
         payload = {"Error": constants.error_403_no_access}
         status = 403
         return payload, status
 
     # library["librarian"]["self"] = get_self(request, constants.users, library["librarian"]["id"])
 
-    for book in library["books"]:
+    return serializers.library(serializers.get_links(request), library), 200
+
+
+# Returns a page of the books in a library, the same way get_book_page does for all books.
+# Returns an error message and 403 status if the library does not belong to the user.
+# Returns an error message and 404 status if the library is not found.
+def get_library_book_page(dsClient, request, library_id, sub):
+
+    if user_owns_library(dsClient, library_id, sub) is False:
+
+        if library_exists(dsClient, library_id) is False:
+
+            return {"Error": constants.error_404_no_library}, 404
+
+        return {"Error": constants.error_403_no_access}, 403
+
+    try:
+        results, next_url, count = get_page_info(dsClient, request, constants.books, "library.id",
+                                                 str(int(library_id)))
+
+    except ValueError:
 
-        book["self"] = get_self(request, constants.books, book["id"])
+        return {"Error": constants.error_400_page}, 400
 
-    return library, 200
+    links = serializers.get_links(request)
+    books = [serializers.book(links, book) for book in results]
+
+    output = {"next": next_url, "count": count, "books": books}
+
+    return output, 200
 
 
 # Returns a book with the provided id and self link.  Returns an error message if the entity is not found.
 # Otherwise, returns a book entity along with a status code.
 def get_book_with_status(dsClient, request, id):
 
-    book, status = get_entity_with_info(dsClient, request, constants.books, id)
+    book, status = get_entity_with_status(dsClient, constants.books, id)
 
     if status == 404:
         # We couldn't find a book with that id.
         return {"Error": constants.error_404_no_book}, 404
 
-    if book["library"] is not None:
-
-        book["library"]["self"] = get_self(request, constants.libraries, book["library"]["id"])
-
-    return book, 200
+    return serializers.book(serializers.get_links(request), book), 200
 
 
 # Returns a list of all occurrences of a given kind of entity with id and self link included.
@@ -193,18 +305,105 @@ def get_entity_list(dsClient, request, kindOfEntity):
     return results, 200
 
 
-def get_user_list(dsClient, request):
+# Returns a page of users, paginated like get_book_page.
+# ?view=summary returns only each user's id and email, read with a projection query so nothing else is fetched.
+# ?expand=libraries adds the libraries each user owns, with self links.  Without it the summary view has no
+# libraries, and neither does the full view in the indexed membership mode.
+# { next: link to next page
+#   count: number of users
+#   users: [{user1}, {user2}, {user3}] }
+def get_user_page(dsClient, request):
+
+    try:
+        view, expand_libraries, projection = get_user_view(request)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_user_view}, 400
+
+    def count():
+
+        return counters.get_count(dsClient, constants.users)
+
+    try:
+        results, next_url, count = get_page_info(dsClient, request, constants.users, count=count,
+                                                 projection=projection)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_page}, 400
+
+    links = serializers.get_links(request)
+
+    def serialize(u):
+
+        return serialize_user(dsClient, links, u, view, expand_libraries)
+
+    # In the indexed membership mode each user's libraries take a query of their own, so they're all looked up at
+    # once.
+    if expand_libraries and membership.is_indexed():
+
+        users = concurrency.map_all(serialize, results)
+
+    else:
+
+        users = [serialize(u) for u in results]
+
+    output = {"next": next_url, "count": count, "users": users}
+
+    return output, 200
+
+
+# Returns every user, formatted the same way as get_user_page, as a generator that fetches one page at a time.
+def get_user_stream(dsClient, request):
+
+    try:
+        view, expand_libraries, projection = get_user_view(request)
+
+    except ValueError:
 
-    query = dsClient.query(kind=constants.users)
-    users = list(query.fetch())
-    for u in users:
-        u["id"] = str(u.key.id)
+        return {"Error": constants.error_400_user_view}, 400
 
-        for library in u["libraries"]:
+    links = serializers.get_links(request)
+    users = iter_entities(dsClient, constants.users, projection=projection)
 
-            library["self"] = get_self(request, constants.libraries, library["id"])
+    return (serialize_user(dsClient, links, u, view, expand_libraries) for u in users), 200
 
-    return users, 200
+
+# Reads the view and expand query parameters of GET /users.  Returns the view, whether to expand libraries, and the
+# projection to query with (None for whole entities).  Raises ValueError if either parameter is invalid.
+def get_user_view(request):
+
+    view = request.args.get("view", "full")
+    expand = request.args.get("expand", "").split(",")
+
+    if view not in ["full", "summary"] or any(e not in ["", "libraries"] for e in expand):
+
+        raise ValueError("Unknown view or expansion.")
+
+    expand_libraries = "libraries" in expand
+
+    # Owned libraries come from the full entity in the embedded mode, so a projection only works without them.
+    projection = None
+
+    if view == "summary" and not (expand_libraries and not membership.is_indexed()):
+
+        projection = ["email"]
+
+    return view, expand_libraries, projection
+
+
+# Serializes a user for get_user_page.  The owned libraries are looked up if they were asked for or the user entity
+# lists them.
+def serialize_user(dsClient, links, u, view, expand_libraries):
+
+    library_ids = None
+
+    if expand_libraries or (view == "full" and "libraries" in u):
+
+        library_ids = membership.get_owned_library_ids(dsClient, u)
+
+    return serializers.user(links, u, view == "summary", library_ids)
 
 
 # Return a list of all libraries where the librarian's unique_id matches the user's JWT sub value.
@@ -238,7 +437,7 @@ def delete_entity(dsClient, kindOfEntity, errorMessage, id):
     return "", 204
 
 
-def delete_library(dsClient, id, sub):
+def delete_library(dsClient, request, id, sub):
 
     library_key = dsClient.key(constants.libraries, int(id))
     library = dsClient.get(key=library_key)
@@ -248,86 +447,241 @@ def delete_library(dsClient, id, sub):
         # We couldn't find a library with that id.
         return {"Error": constants.error_404_no_library}, 404
 
-    elif user_owns_library(dsClient, id, sub) is False:
+    elif is_librarian(dsClient, library, sub) is False:
 
         return {"Error": constants.error_403_no_access}, 403
 
-    # Similar structure as our Viewing Reservations example in Demo of Intermediate REST API Features in Python
-    # adjusted to change my book values.
-    for book in library["books"]:
-        book_key = dsClient.key(constants.books, int(book["id"]))
-        book_entity = dsClient.get(key=book_key)
-        book_entity["library"] = None
-        dsClient.put(book_entity)
-
-    # Need to delete the library from the user as well
-    user_id = library["librarian"]["id"]
-    user_key = dsClient.key(constants.users, int(user_id))
-    user = dsClient.get(key=user_key)
-    # Remove our library from the user
-    # https://www.geeksforgeeks.org/python-removing-dictionary-from-list-of-dictionaries/
-    # https://docs.python.org/3/library/stdtypes.html#range
-    for i in range(len(user["libraries"])):
-
-        if user["libraries"][i]["id"] == id:
-            del user["libraries"][i]
-            dsClient.put(user)
-            break
-
-    dsClient.delete(library_key)
+    elif etags.matches(request, library) is False:
 
-    return "", 204
+        return {"Error": constants.error_412_etag}, 412
+
+    owner = principal.get_principal(dsClient, sub)
+
+    book_keys = membership.get_book_keys(dsClient, library)
+
+    # A commit can only hold batch_size mutations, and the last one also has to update the user and delete the
+    # library.  Libraries with more books than that have their books released in earlier transactions.  If one of
+    # those fails the library is still there, and deleting it again picks up where this left off.
+    room = constants.batch_size - 2
+    chunks = list(get_chunks(book_keys, room)) or [[]]
+    released = []
+
+    # Reads the library again in the transaction, so a book put in it since book_keys was read makes the commit
+    # conflict.  An If-Match header is checked again with the first commit, in case the library changed since it was
+    # read, so a refused request changes nothing.
+    def read_library():
+
+        current = dsClient.get(key=library_key)
+
+        if current is None:
+
+            return None, ({"Error": constants.error_404_no_library}, 404)
+
+        if len(released) == 0 and etags.matches(request, current) is False:
+
+            return None, ({"Error": constants.error_412_etag}, 412)
+
+        return current, None
+
+    for chunk in chunks[:-1]:
+
+        def release_chunk():
 
+            current, error = read_library()
 
-def delete_book(dsClient, id):
+            if error is not None:
+
+                return error
+
+            # In the embedded membership mode the library stops listing the books as they are released.
+            changed = [membership.remove_book(current, book.key.id) for book in release_books(dsClient, chunk, id)]
+
+            if any(changed):
+
+                dsClient.put(current)
+
+            return None
+
+        error = transactions.run_in_transaction(dsClient, release_chunk)
+
+        if error is not None:
+
+            return error
+
+        entity_cache.invalidate(chunk + [library_key])
+        released.extend(chunk)
+
+    def remove_library():
+
+        current, error = read_library()
+
+        if error is not None:
+
+            return error, []
+
+        # The library read in this transaction lists every book put in it since book_keys was read.  In the indexed
+        # mode those books are found after the delete instead.
+        keys = chunks[-1] if membership.is_indexed() else membership.get_book_keys(dsClient, current)
+
+        release_books(dsClient, keys[:room], id)
+
+        # Need to delete the library from the user as well.  We already know the user owns it, so the librarian is
+        # the user making the request.
+        if not membership.is_indexed():
+
+            user = dsClient.get(key=dsClient.key(constants.users, owner.user_id))
+
+            if membership.remove_library(user, id):
+
+                dsClient.put(user)
+
+        dsClient.delete(library_key)
+
+        return ("", 204), keys[room:]
+
+    (payload, status), leftover = transactions.run_in_transaction(dsClient, remove_library)
+
+    if status == 204:
+
+        entity_cache.invalidate(chunks[-1] + [library_key])
+        owner.remove_library(id)
+
+        # A book can't be put in the library once it is deleted, so any book still pointing at it was put there
+        # before the delete committed.  Those are released now.
+        if membership.is_indexed():
+
+            leftover = queries.get_keys_where(dsClient, constants.books, "library.id", str(library_key.id))
+
+        for chunk in get_chunks(leftover, constants.batch_size):
+
+            transactions.run_in_transaction(dsClient, lambda: release_books(dsClient, chunk, id))
+            entity_cache.invalidate(chunk)
+
+    return payload, status
+
+
+# Takes the books with these keys out of the library with library_id, in one get_multi and one put_multi.
+# Books that have already been moved out of that library are left alone.  Returns the books that were taken out.
+def release_books(dsClient, book_keys, library_id):
+
+    if len(book_keys) == 0:
+        return []
+
+    books = dsClient.get_multi(book_keys)
+    released = []
+
+    for book in books:
+
+        if book["library"] is not None and book["library"]["id"] == library_id:
+
+            set_library(book, None)
+            released.append(book)
+
+    if len(released) != 0:
+
+        dsClient.put_multi(released)
+
+    return released
+
+
+# Splits items into lists of at most size items.
+def get_chunks(items, size):
+
+    for i in range(0, len(items), size):
+
+        yield items[i:i + size]
+
+
+def delete_book(dsClient, request, id):
 
     book_key = dsClient.key(constants.books, int(id))
-    book = dsClient.get(key=book_key)
 
-    # https://realpython.com/null-in-python/
-    if book is None:
-        # We couldn't find a book with that id.
-        return {"Error": constants.error_404_no_book}, 404
+    # Every key written by the last attempt, for the entity cache.
+    written = []
 
-    if book["library"] is not None:
+    # The book's library loses its reference in the same commit that deletes the book.
+    def remove_book():
 
-        library_id = book["library"]["id"]
-        library_key = dsClient.key(constants.libraries, int(library_id))
-        library = dsClient.get(key=library_key)
+        book = dsClient.get(key=book_key)
 
-        # Remove our book from the library
-        # https://www.geeksforgeeks.org/python-removing-dictionary-from-list-of-dictionaries/
-        # https://docs.python.org/3/library/stdtypes.html#range
-        for i in range(len(library["books"])):
+        # https://realpython.com/null-in-python/
+        if book is None:
+            # We couldn't find a book with that id.
+            return {"Error": constants.error_404_no_book}, 404
+
+        if etags.matches(request, book) is False:
+
+            return {"Error": constants.error_412_etag}, 412
+
+        written[:] = [book_key]
+
+        if book["library"] is not None and not membership.is_indexed():
+
+            library_id = book["library"]["id"]
+            library_key = dsClient.key(constants.libraries, int(library_id))
+            library = dsClient.get(key=library_key)
+
+            # Remove our book from the library
+            if membership.remove_book(library, id):
 
-            if library["books"][i]["id"] == id:
-                del library["books"][i]
                 dsClient.put(library)
-                break
+                written.append(library_key)
 
-    dsClient.delete(book_key)
+        dsClient.delete(book_key)
 
-    return "", 204
+        return "", 204
+
+    payload, status = transactions.run_in_transaction(dsClient, remove_book)
 
+    if status == 204:
 
-# Updates a kindOfEntity that has the provided id.
-# Returns None with a status of 404 if no such entity with that id exists. Otherwise, returns the updated entity with
-# a 200 status code.
+        entity_cache.invalidate(written)
+        counters.increment(dsClient, constants.books, -1)
+
+    return payload, status
+
+
+# Updates a kindOfEntity that has the provided id.  The entity is read and written in one transaction, so a change
+# made in between (like the book being put in a library) isn't lost.
+# Returns None with a status of 404 if no such entity with that id exists, or 412 if the request has an If-Match
+# header the entity doesn't match. Otherwise, returns the updated entity with a 200 status code.
 def update_entity(dsClient, request, content, listOfKeys, kindOfEntity, id):
 
-    entity = dsClient.get(key=dsClient.key(kindOfEntity, int(id)))
+    entity_key = dsClient.key(kindOfEntity, int(id))
+
+    def update():
 
-    # https://realpython.com/null-in-python/
-    if entity is None:
-        # We couldn't find a entity with that id.
-        return None, 404
+        entity = dsClient.get(key=entity_key)
+
+        # https://realpython.com/null-in-python/
+        if entity is None:
+            # We couldn't find a entity with that id.
+            return None, 404
+
+        if etags.matches(request, entity) is False:
+
+            return None, 412
+
+        newInfo = fill_entity(content, listOfKeys)
+        entity.update(newInfo)
+
+        if kindOfEntity == constants.books:
+
+            search.index_book(entity)
+
+        dsClient.put(entity)
 
-    newInfo = fill_entity(content, listOfKeys)
-    entity.update(newInfo)
-    dsClient.put(entity)
+        return entity, 200
 
-    entity["id"] = str(entity.key.id)
-    entity["self"] = get_self(request, kindOfEntity, entity["id"])
+    entity, status = transactions.run_in_transaction(dsClient, update)
+
+    if status != 200:
+
+        return entity, status
+
+    entity_cache.invalidate([entity_key])
+
+    etags.set_etag(entity)
 
     return entity, 200
 
@@ -340,18 +694,26 @@ def update_library(dsClient, request, attributesToChange, id, sub):
 
     content = request.get_json()
 
+    # Check ownership before writing so a user can't change a library that isn't theirs.
+    if user_owns_library(dsClient, id, sub) is False:
+
+        if library_exists(dsClient, id) is False:
+
+            return {"Error": constants.error_404_no_library}, 404
+
+        return {"Error": constants.error_403_no_access}, 403
+
     library, status = update_entity(dsClient, request, content, attributesToChange, constants.libraries, id)
 
     if status == 404:
 
-        library = {"Error": constants.error_404_no_library}
+        return {"Error": constants.error_404_no_library}, 404
 
-    elif user_owns_library(dsClient, id, sub) is False:
+    elif status == 412:
 
-        library = {"Error": constants.error_403_no_access}
-        status = 403
+        return {"Error": constants.error_412_etag}, 412
 
-    return library, status
+    return serializers.library(serializers.get_links(request), library), status
 
 
 # Patches parts of an library entity.  The library may have any attribute updated expect for id or attributes related
@@ -384,15 +746,19 @@ def put_library(dsClient, request, id, sub):
 # The book will be returned with it's id and self attributes added.
 def update_book(dsClient, request, attributesToChange, id):
 
-    content = request.get_json()
+    changes = get_book_changes(request.get_json(), attributesToChange)
 
-    library, status = update_entity(dsClient, request, content, attributesToChange, constants.books, id)
+    book, status = update_entity(dsClient, request, changes, list(changes), constants.books, id)
 
     if status == 404:
 
-        library = {"Error": constants.error_404_no_book}
+        return {"Error": constants.error_404_no_book}, 404
 
-    return library, status
+    elif status == 412:
+
+        return {"Error": constants.error_412_etag}, 412
+
+    return serializers.book(serializers.get_links(request), book), status
 
 
 # Patches parts of an book entity.  The book may have any attribute updated expect for id or attributes related
@@ -402,6 +768,10 @@ def patch_book(dsClient, request, id):
 
     content = request.get_json()
 
+    if is_valid_book(content, []) is False:
+
+        return {"Error": constants.error_400_book}, 400
+
     potential_keys = ["title", "author", "illustrator"]
     keysFound = getValidKeys(content, potential_keys)
 
@@ -416,6 +786,10 @@ def put_book(dsClient, request, id):
 
     keysExpected = ["title", "author", "illustrator"]
 
+    if is_valid_book(content, keysExpected) is False:
+
+        return {"Error": constants.error_400_book}, 400
+
     return update_book(dsClient, request, keysExpected, id)
 
 
@@ -442,27 +816,13 @@ def get_self(request, name, id):
 # Returns true if a library with this id exists.  Returns false, otherwise.
 def library_exists(dsClient, id):
 
-    library_key = dsClient.key(constants.libraries, int(id))
-    library = dsClient.get(key=library_key)
-
-    if library is None:
-
-        return False
-
-    return True
+    return queries.key_exists(dsClient, constants.libraries, id)
 
 
 # Returns true if a book with this id exists.  Returns false, otherwise.
 def book_exists(dsClient, id):
 
-    library_key = dsClient.key(constants.libraries, int(id))
-    library = dsClient.get(key=library_key)
-
-    if library is None:
-
-        return False
-
-    return True
+    return queries.key_exists(dsClient, constants.books, id)
 
 
 # Returns a list of all occurrences of a library with id and self link included.
@@ -476,23 +836,25 @@ def get_library_page(dsClient, request, sub):
     # offset = int(request.args.get('offset', 0))
 
     # Convert sub to user id
-    user_id = convert_sub_to_user_id(dsClient, sub)
+    owner = principal.get_principal(dsClient, sub)
 
     filter_criteria = "librarian.id"
-    filter_value = user_id
-
-    results, next_url, count = get_page_info(dsClient, request, constants.libraries, filter_criteria, filter_value)
+    filter_value = owner.user_id
 
-    for library in results:
+    # The principal's library ids can be behind on libraries made through another instance, so the total comes from
+    # a keys-only count, run alongside the page fetch.
+    try:
+        results, next_url, count = get_page_info(dsClient, request, constants.libraries, filter_criteria,
+                                                 filter_value)
 
-        library["id"] = str(library.key.id)
-        library["self"] = get_self(request, constants.libraries, library["id"])
+    except ValueError:
 
-        for book in library["books"]:
+        return {"Error": constants.error_400_page}, 400
 
-            book["self"] = get_self(request, constants.books, book["id"])
+    links = serializers.get_links(request)
+    libraries = [serializers.library(links, library) for library in results]
 
-    output = {"next": next_url, "count": count, "libraries": results}
+    output = {"next": next_url, "count": count, "libraries": libraries}
 
     return output, 200
 
@@ -502,70 +864,346 @@ def get_library_page(dsClient, request, sub):
 # Now have to add pagination
 # { next: link to next page
 #   loads: [{load1}, {load2}, {load3}] }
+# The books can be filtered and sorted as get_book_query describes.  A filtered page counts only the matching books.
 def get_book_page(dsClient, request):
 
     # offset = int(request.args.get('offset', 0))
 
-    results, next_url, count = get_page_info(dsClient, request, constants.books)
+    try:
+        filters, order = get_book_query(request)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_book_query}, 400
+
+    # The sharded counter only knows the total, so a filtered page is counted with a keys-only query.
+    if len(filters) == 0:
+
+        def count():
+
+            return counters.get_count(dsClient, constants.books)
 
-    for book in results:
-        book["id"] = str(book.key.id)
-        book["self"] = get_self(request, constants.books, book["id"])
+    else:
+
+        count = None
+
+    try:
+        results, next_url, count = get_page_info(dsClient, request, constants.books, count=count, filters=filters,
+                                                 order=order)
+
+    except ValueError:
 
-        if book["library"] is not None:
-            book["library"]["self"] = get_self(request, constants.books, book["library"]["id"])
+        return {"Error": constants.error_400_page}, 400
 
-    output = {"next": next_url, "count": count, "books": results}
+    links = serializers.get_links(request)
+    books = [serializers.book(links, book) for book in results]
+
+    output = {"next": next_url, "count": count, "books": books}
 
     return output, 200
 
 
+# Returns every book with id and self links, as a generator that fetches one page at a time.  Takes the same filters
+# and sort as get_book_page.
+def get_book_stream(dsClient, request):
+
+    try:
+        filters, order = get_book_query(request)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_book_query}, 400
+
+    links = serializers.get_links(request)
+    books = iter_entities(dsClient, constants.books, filters=filters, order=order)
+
+    return (serializers.book(links, book) for book in books), 200
+
+
+# Returns a page of the books that have every word of the q query parameter, best match first (see search.py).
+# { "next": link to the next page,
+#   "count": how many books were ranked,
+#   "truncated": true if more books matched than could be ranked, in which case count is a lower bound,
+#   "books": [{book1}, {book2}, {book3}] }
+# The ranking is worked out again for every page, and the cursor is the position of the page in it.
+def search_books(dsClient, request):
+
+    terms = search.get_query_terms(request.args.get("q", ""))
+
+    if len(terms) == 0 or len(terms) > constants.max_search_query_terms:
+
+        return {"Error": constants.error_400_search}, 400
+
+    try:
+        limit = get_page_limit(request)
+        start = int(request.args.get("cursor", 0))
+
+        if start < 0:
+
+            raise ValueError("The cursor can't be negative.")
+
+    except ValueError:
+
+        return {"Error": constants.error_400_page}, 400
+
+    results, truncated = search.find_books(dsClient, terms)
+
+    if start + limit < len(results):
+
+        next_url = get_next_url(request, limit, str(start + limit))
+
+    else:
+
+        next_url = None
+
+    links = serializers.get_links(request)
+    books = [serializers.book(links, book) for book in results[start:start + limit]]
+
+    return {"next": next_url, "count": len(results), "truncated": truncated, "books": books}, 200
+
+
+# The sort query parameter's values, and the property each one orders by.  Titles sort by title_lower, so the order
+# doesn't depend on capitalization.
+book_sorts = {"title": "title_lower", "-title": "-title_lower", "author": "author", "-author": "-author"}
+
+
+# Returns the first string after every string that starts with prefix: prefix with its last character moved on by
+# one.  Returns None if there isn't one, because prefix is made only of the highest character.  Datastore compares
+# strings as UTF-8 bytes, which sorts them the same as their code points.  Surrogates can't be stored, so the character
+# after U+D7FF is U+E000.
+def get_prefix_end(prefix):
+
+    prefix = prefix.rstrip(chr(0x10FFFF))
+
+    if prefix == "":
+
+        return None
+
+    next_character = ord(prefix[-1]) + 1
+
+    if 0xD800 <= next_character <= 0xDFFF:
+
+        next_character = 0xE000
+
+    return prefix[:-1] + chr(next_character)
+
+
+# Returns the filters and sort order that GET /books asked for with its query parameters:
+#   author=<text>         only books by exactly this author
+#   illustrator=<text>    only books with exactly this illustrator
+#   title_prefix=<text>   only books whose title starts with this text, ignoring case
+#   shelved=true|false    only books that are, or aren't, in a library
+#   sort=<order>          title, -title, author or -author.  The default is the order the books were created in.
+# Every combination is answered by an index (see index.yaml), so a page costs the same however many books there are.
+# Datastore has to sort a range filter's property first, so a title_prefix can only be sorted by title.
+# Raises ValueError if the sort or shelved isn't one of these, or the sort can't be used with the filters.
+def get_book_query(request):
+
+    filters = []
+
+    for property_name in ["author", "illustrator"]:
+
+        if property_name in request.args:
+
+            filters.append((property_name, "=", request.args[property_name]))
+
+    shelved = request.args.get("shelved")
+
+    if shelved is not None:
+
+        if shelved not in ["true", "false"]:
+
+            raise ValueError("shelved must be true or false.")
+
+        filters.append(("shelved", "=", shelved == "true"))
+
+    order = None
+    sort = request.args.get("sort")
+
+    if sort is not None:
+
+        if sort not in book_sorts:
+
+            raise ValueError("Unknown sort " + sort)
+
+        order = [book_sorts[sort]]
+
+    prefix = request.args.get("title_prefix", "").lower()
+
+    if prefix != "":
+
+        if order is None:
+
+            order = ["title_lower"]
+
+        elif order[0].lstrip("-") != "title_lower":
+
+            raise ValueError("A title_prefix can only be sorted by title.")
+
+        filters.append(("title_lower", ">=", prefix))
+
+        end = get_prefix_end(prefix)
+
+        if end is not None:
+
+            filters.append(("title_lower", "<", end))
+
+    return filters, order
+
+
+# Returns every library the user owns with id and self links, as a generator that fetches one page at a time.
+def get_library_stream(dsClient, request, sub):
+
+    owner = principal.get_principal(dsClient, sub)
+    links = serializers.get_links(request)
+    libraries = iter_entities(dsClient, constants.libraries, "librarian.id", owner.user_id)
+
+    return (serializers.library(links, library) for library in libraries), 200
+
+
+# Yields every entity of a kind, optionally filtered and ordered like get_page_info, fetching stream_page_size at a
+# time.  Only one page is held in memory, and the next one isn't fetched until the caller has used up the last.
+def iter_entities(dsClient, type, filter_criteria=None, filter_value=None, projection=None, filters=(), order=None):
+
+    cursor = None
+
+    while True:
+
+        query = get_query(dsClient, type, filter_criteria, filter_value, projection, filters, order)
+
+        l_iterator = query.fetch(limit=constants.stream_page_size, start_cursor=cursor)
+        results = list(next(l_iterator.pages))
+
+        for entity in results:
+
+            yield entity
+
+        cursor = l_iterator.next_page_token
+
+        if cursor is None or len(results) < constants.stream_page_size:
+
+            return
+
+
+# Returns the page size asked for with the limit query parameter.  Defaults to 5 and is capped at max_page_limit.
+# Raises ValueError if limit is not a positive number.
+def get_page_limit(request):
+
+    limit = int(request.args.get('limit', constants.default_page_limit))
+
+    if limit < 1:
+
+        raise ValueError("The limit must be at least 1.")
+
+    return min(limit, constants.max_page_limit)
+
+
+# Builds the link to the page after this one.  Every query parameter of the current request is kept except the
+# offset, which the cursor replaces.
+def get_next_url(request, limit, cursor):
+
+    args = request.args.to_dict()
+    args.pop("offset", None)
+    args["limit"] = str(limit)
+    args["cursor"] = cursor
+
+    return request.base_url + "?" + urlencode(args)
+
+
+# Builds a query of a kind.  filter_criteria and filter_value add one equality filter, and filters is a list of
+# (property, operator, value) filters to add as well.  projection, if given, lists the only properties to fetch, and
+# order, if given, lists the properties to sort on (a leading "-" sorts descending).
+def get_query(dsClient, type, filter_criteria=None, filter_value=None, projection=None, filters=(), order=None):
+
+    query = dsClient.query(kind=type)
+
+    if filter_criteria is not None and filter_value is not None:
+
+        query.add_filter(filter_criteria, "=", filter_value)
+
+    for property_name, operator, value in filters:
+
+        query.add_filter(property_name, operator, value)
+
+    if projection is not None:
+
+        query.projection = projection
+
+    if order is not None:
+
+        query.order = order
+
+    return query
+
+
 # Gets all the page information for a given entity.  You may add one filtering criteria for the page using the
-# filter_criteria and filter_value parameters.
+# filter_criteria and filter_value parameters, and more with filters and order as get_query takes them.  Callers that
+# already know the total can pass it as count, or pass a function that looks it up.  Otherwise the matching entities
+# are counted with a keys-only query.  Lookups of the total run at the same time as the page is fetched.  projection,
+# if given, lists the only properties to fetch.
+# Pages are walked with the opaque cursor in each next link.  Links with an offset still work, and are answered with
+# cursor links from then on.
 # Returns the resulting page, next_url, and count of total entities in all the pages.
-# This version has a limit of 5 items per page.
-def get_page_info(dsClient, request, type, filter_criteria=None, filter_value=None):
+# Raises ValueError if the limit, offset or cursor parameters are invalid.
+def get_page_info(dsClient, request, type, filter_criteria=None, filter_value=None, count=None, projection=None,
+                  filters=(), order=None):
 
-    limit = 5
+    limit = get_page_limit(request)
     # http://classes.engr.oregonstate.edu/eecs/perpetual/cs493-400/modules/4-more-rest-api-creation/5-use-demo-python/
     q_offset = int(request.args.get('offset', 0))
-    query = dsClient.query(kind=type)
+    cursor = request.args.get('cursor')
 
-    if filter_criteria is not None and filter_value is not None:
+    if q_offset < 0:
 
-        query.add_filter(filter_criteria, "=", filter_value)
+        raise ValueError("The offset can't be negative.")
+
+    query = get_query(dsClient, type, filter_criteria, filter_value, projection, filters, order)
+
+    l_iterator = None
+
+    def fetch_page():
 
-    count = len(list(query.fetch()))
+        nonlocal l_iterator
 
-    l_iterator = query.fetch(limit=limit, offset=q_offset)
-    pages = l_iterator.pages
-    results = list(next(pages))
+        l_iterator = query.fetch(limit=limit, offset=q_offset, start_cursor=cursor)
 
-    if l_iterator.next_page_token:
+        try:
+            return list(next(l_iterator.pages))
 
-        next_offset = q_offset + 5
-        next_url = request.base_url + "?limit=" + str(limit) + "&offset=" + str(next_offset)
+        except exceptions.BadRequest:
+
+            # Datastore didn't recognize the cursor.
+            raise ValueError("The cursor is invalid.")
+
+    if count is None:
+
+        results, count = concurrency.run_all(
+            fetch_page, lambda: counters.count_entities(dsClient, type, filter_criteria, filter_value, filters))
+
+    elif callable(count):
+
+        results, count = concurrency.run_all(fetch_page, count)
 
     else:
 
-        next_url = None
+        results = fetch_page()
 
-    return results, next_url, count
+    # A short page means we reached the end, even if Datastore hands back a cursor.
+    if l_iterator.next_page_token and len(results) == limit:
 
+        next_url = get_next_url(request, limit, l_iterator.next_page_token.decode("ascii"))
 
-# Returns true if the sub value matches a user in datastore.  Returns false, otherwise.
-def sub_matches_user(dsClient, sub):
+    else:
 
-    query = dsClient.query(kind=constants.users)
-    query.add_filter("unique_id", "=", sub)
+        next_url = None
 
-    results = list(query.fetch())
+    return results, next_url, count
 
-    if len(results) == 1:
 
-        return True
+# Returns true if the sub value matches a user in datastore.  Returns false, otherwise.
+def sub_matches_user(dsClient, sub):
 
-    return False
+    return principal.get_principal(dsClient, sub) is not None
 
 
 # Returns true if the application is requesting JSON for the returned body.
@@ -580,90 +1218,282 @@ def is_requesting_json(request):
     return False
 
 
-# Place a book in a library.
+# Returns the entities with these keys in the same order, with None for any that don't exist.  One get_multi call.
+def get_entities(dsClient, keys):
+
+    found = {}
+
+    for entity in dsClient.get_multi(keys):
+
+        found[entity.key] = entity
+
+    return [found.get(key) for key in keys]
+
+
+# Place a book in a library.  The library and the book are read and written in one transaction, so two requests
+# can't put the same book in two libraries or lose each other's change to the library's list of books.
 def put_book_in_library(dsClient, request, library_id, book_id, sub):
 
-    library, library_status = get_library_with_status(dsClient, request, library_id, sub)
+    library_key = dsClient.key(constants.libraries, int(library_id))
+    book_key = dsClient.key(constants.books, int(book_id))
+
+    def check_in():
+
+        library, book = get_entities(dsClient, [library_key, book_key])
+
+        if library is None or book is None:
+
+            return {"Error": constants.error_404_put}, 404
+
+        elif book["library"] is not None or is_librarian(dsClient, library, sub) is False:
+
+            return {"Error": constants.error_403_put}, 403
 
-    book, book_status = get_book_with_status(dsClient, request, book_id)
+        # Update our book with the library's information.
+        set_library(book, library_key.id)
 
-    if library_status == 404 or book_status == 404:
+        # Add our book to the library.  In the indexed membership mode only the book changes.
+        if membership.add_book(library, book_key.id):
 
-        return {"Error": constants.error_404_put}, 404
+            dsClient.put_multi([book, library])
 
-    elif book["library"] is not None or library_status == 403:
+        else:
 
-        return {"Error": constants.error_403_put}, 403
+            dsClient.put(book)
 
-    # Update our book with the library's information.
-    book["library"] = {
-        "id": library["id"]
-    }
-    dsClient.put(book)
+        return '', 204
 
-    # Add our book to the library.
-    library["books"].append({"id": book["id"]})
-    dsClient.put(library)
+    message, status = transactions.run_in_transaction(dsClient, check_in)
 
-    return '', 204
+    if status == 204:
 
+        entity_cache.invalidate([library_key, book_key])
 
+    return message, status
+
+
+# Take a book out of a library.  Like put_book_in_library, both writes happen in one transaction.
 def remove_book_from_library(dsClient, request, library_id, book_id, sub):
 
-    library, library_status = get_library_with_status(dsClient, request, library_id, sub)
+    library_key = dsClient.key(constants.libraries, int(library_id))
+    book_key = dsClient.key(constants.books, int(book_id))
 
-    book, book_status = get_book_with_status(dsClient, request, book_id)
+    def check_out():
 
-    ids_match = book["library"] is not None and book["library"]["id"] == library["id"]
+        library, book = get_entities(dsClient, [library_key, book_key])
 
-    if library_status == 404 or book_status == 404 or ids_match is False:
+        ids_match = library is not None and book is not None and book["library"] is not None \
+            and book["library"]["id"] == str(library_key.id)
 
-        return {"Error": constants.error_404_delete}, 404
+        if ids_match is False:
 
-    elif library_status == 403:
+            return {"Error": constants.error_404_delete}, 404
 
-        return {"Error": constants.error_403_delete}, 403
+        elif is_librarian(dsClient, library, sub) is False:
 
-    # Remove the library.
-    book["library"] = None
-    dsClient.put(book)
+            return {"Error": constants.error_403_delete}, 403
 
-    # Remove our book from the library
-    # https://www.geeksforgeeks.org/python-removing-dictionary-from-list-of-dictionaries/
-    # https://docs.python.org/3/library/stdtypes.html#range
-    for i in range(len(library["books"])):
+        # Remove the library.
+        set_library(book, None)
 
-        if library["books"][i]["id"] == book_id:
-            del library["books"][i]
-            dsClient.put(library)
-            break
+        # Remove our book from the library
+        if membership.remove_book(library, book_key.id):
 
-    return "", 204
+            dsClient.put_multi([book, library])
+
+        else:
+
+            dsClient.put(book)
+
+        return "", 204
+
+    message, status = transactions.run_in_transaction(dsClient, check_out)
+
+    if status == 204:
+
+        entity_cache.invalidate([library_key, book_key])
+
+    return message, status
+
+
+# Puts many books in a library and takes many out, in one transaction.  The body is
+# { "shelve": [book ids], "unshelve": [book ids] }
+# and together they may hold up to batch_size - 1 ids, so the books and the library fit in one commit.  The library
+# and every book are read with one get_multi.  A book that can't be moved doesn't stop the others.  Each id gets a
+# result, the shelve list's first:
+#   204 - moved (or already where it was asked to be)
+#   404 - no such book, or, when unshelving, the book isn't in this library
+#   409 - the book is already in another library
+# Returns the results with a 200 status, an error message and 400 status if the body is invalid, or the same 403 and
+# 404 errors as get_library_book_page if the user can't change the library.
+def shelve_books(dsClient, request, library_id, sub):
+
+    content = request.get_json(silent=True)
+
+    try:
+        shelve, unshelve = get_shelving_ids(content)
+
+    except ValueError:
+
+        return {"Error": constants.error_400_shelve}, 400
+
+    if user_owns_library(dsClient, library_id, sub) is False:
+
+        if library_exists(dsClient, library_id) is False:
+
+            return {"Error": constants.error_404_no_library}, 404
+
+        return {"Error": constants.error_403_no_access}, 403
+
+    library_key = dsClient.key(constants.libraries, int(library_id))
+    book_ids = list(dict.fromkeys(shelve + unshelve))
+    book_keys = [dsClient.key(constants.books, book_id) for book_id in book_ids]
+
+    def move_books():
+
+        entities = get_entities(dsClient, [library_key] + book_keys)
+        library = entities[0]
+        books = dict(zip(book_ids, entities[1:]))
+
+        if library is None:
+
+            return {"Error": constants.error_404_no_library}, 404
+
+        results = []
+        changed = {}
+        library_changed = False
+
+        for book_id in shelve:
+
+            book = books[book_id]
+
+            if book is None:
+
+                results.append({"id": str(book_id), "status": 404, "Error": constants.error_404_no_book})
+
+            elif book["library"] is None:
+
+                set_library(book, library_key.id)
+                library_changed = membership.add_book(library, book_id) or library_changed
+                changed[book_id] = book
+                results.append({"id": str(book_id), "status": 204})
+
+            elif book["library"]["id"] == str(library_key.id):
+
+                results.append({"id": str(book_id), "status": 204})
+
+            else:
+
+                results.append({"id": str(book_id), "status": 409, "Error": constants.error_409_shelved})
+
+        for book_id in unshelve:
+
+            book = books[book_id]
+
+            if book is None or book["library"] is None or book["library"]["id"] != str(library_key.id):
+
+                results.append({"id": str(book_id), "status": 404, "Error": constants.error_404_delete})
+                continue
+
+            set_library(book, None)
+            library_changed = membership.remove_book(library, book_id) or library_changed
+            changed[book_id] = book
+            results.append({"id": str(book_id), "status": 204})
+
+        writes = list(changed.values())
+
+        if library_changed:
+
+            writes.append(library)
+
+        if len(writes) != 0:
+
+            dsClient.put_multi(writes)
+
+        return {"results": results}, 200
+
+    results, status = transactions.run_in_transaction(dsClient, move_books)
+
+    if status == 200:
+
+        entity_cache.invalidate([library_key] + book_keys)
+
+    return results, status
+
+
+# Returns the book ids (as ints) in the shelve and unshelve lists of a shelve_books body.  Raises ValueError if the
+# body isn't valid or has too many ids.
+def get_shelving_ids(content):
+
+    if not isinstance(content, dict) or any(key not in ["shelve", "unshelve"] for key in content):
+
+        raise ValueError("Unknown field.")
+
+    lists = [content.get("shelve", []), content.get("unshelve", [])]
+
+    if any(not isinstance(ids, list) for ids in lists) or len(lists[0]) + len(lists[1]) >= constants.batch_size:
+
+        raise ValueError("The ids must be lists, with fewer than batch_size between them.")
+
+    return [get_body_id(book_id) for book_id in lists[0]], [get_body_id(book_id) for book_id in lists[1]]
+
+
+# Returns an id sent in a request body as a positive int.  Raises ValueError if it isn't one.
+# int() would also take booleans and floats, so only strings and ints are accepted.  Datastore refuses ids below 1.
+def get_body_id(value):
+
+    if not isinstance(value, (str, int)) or isinstance(value, bool):
+
+        raise ValueError("Every id must be a string or a number.")
+
+    # int() raises ValueError for strings that aren't numbers.
+    id = int(value)
+
+    if id < 1:
+
+        raise ValueError("Every id must be positive.")
+
+    return id
 
 
 # Returns true if the user owns the library.  Returns false, otherwise.
+# The principal's library ids come from a cache kept by each instance, so a library made through another instance
+# can be missing from them.  They are only trusted to say yes.  Before saying no, the library itself is checked.
 def user_owns_library(dsClient, library_id, sub):
 
-    query = dsClient.query(kind=constants.users)
-    query.add_filter("unique_id", "=", sub)
+    owner = principal.get_principal(dsClient, sub)
+
+    if owner is None:
+
+        return False
 
-    user = list(query.fetch())[0]
+    if owner.owns_library(library_id):
 
-    for library in user["libraries"]:
+        return True
 
-        if library["id"] == library_id:
+    library = entity_cache.get(dsClient, dsClient.key(constants.libraries, int(library_id)))
 
-            return True
+    return library is not None and is_librarian(dsClient, library, sub)
 
-    return False
 
+# Returns true if the user is the librarian of the library entity, which the caller has already read.  A library
+# missing from the user's cached library ids is added to them.
+def is_librarian(dsClient, library, sub):
 
-# Converts a sub value into a user id to make it easier for queries
-def convert_sub_to_user_id(dsClient, sub):
+    owner = principal.get_principal(dsClient, sub)
+
+    if owner is None or library["librarian"]["id"] != owner.user_id:
+
+        return False
+
+    if not owner.owns_library(library.key.id):
 
-    query = dsClient.query(kind=constants.users)
-    query.add_filter("unique_id", "=", sub)
+        owner.add_library(library.key.id)
+
+    return True
 
-    user = list(query.fetch())[0]
 
-    return user.key.id
+# Converts a sub value into a user id to make it easier for queries
+def convert_sub_to_user_id(dsClient, sub):
+
+    return principal.get_principal(dsClient, sub).user_id
@@ -1,15 +1,24 @@
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-from json2html import *
 import json
 import constants
+import etags
 import helper
+import principal
+import storage
+import streaming
 import verify_helper
 
-client = datastore.Client()
+client = storage.get_client()
 
 bp = Blueprint('library', __name__, url_prefix='/libraries')
 
+
+# Every library route needs the user behind the JWT, so look it up once before the view runs.
+@bp.before_request
+def load_principal():
+
+    principal.load_principal(client, request)
+
 # The bits of code on making responses comes straight from the lectures on advanced api
 
 
@@ -25,7 +34,7 @@ def libraries_get_post():
         return res
 
     # Test that the user is requesting JSON and that the user is registered with our application.
-    if helper.is_requesting_json(request) is False:
+    if helper.is_requesting_json(request) is False and streaming.is_ndjson(request) is False:
         return {"Error": constants.error_406_json}, 406
 
     sub = verify_helper.get_sub(request)
@@ -40,6 +49,11 @@ def libraries_get_post():
 
     elif request.method == 'GET':
 
+        if streaming.is_requested(request):
+
+            libraries, status = helper.get_library_stream(client, request, sub)
+            return streaming.respond(request, libraries, status)
+
         # Now have to add pagination
         # { next: link to next page,
         #   count: 3,
@@ -66,19 +80,19 @@ def libraries_get_put_patch_delete(id):
 
             library, status = helper.get_library_with_status(client, request, id, sub)
 
-            return json.dumps(library), status
+            return etags.respond(request, library, status)
 
         elif request.method == 'PUT':
 
             library, status = helper.put_library(client, request, id, sub)
 
-            return json.dumps(library), status
+            return etags.respond(request, library, status)
 
         elif request.method == 'PATCH':
 
             library, status = helper.patch_library(client, request, id, sub)
 
-            return json.dumps(library), status
+            return etags.respond(request, library, status)
 
     elif request.method == 'DELETE':
 
@@ -87,7 +101,7 @@ def libraries_get_put_patch_delete(id):
         if sub is None or helper.sub_matches_user(client, sub) is False:
             return {"Error": constants.error_401_bad_jwt}, 401
 
-        payload, status = helper.delete_library(client, id, sub)
+        payload, status = helper.delete_library(client, request, id, sub)
 
         if status != 204:
 
@@ -103,6 +117,56 @@ def libraries_get_put_patch_delete(id):
         return res
 
 
+@bp.route('/<library_id>/books', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
+def libraries_books_get(library_id):
+
+    if request.method != "GET":
+
+        res = make_response(json.dumps({"Error": constants.error_405_bad_method}))
+        res.mime_type = "application/json"
+        res.status_code = 405
+        res.headers.set("Allow", ["GET"])
+        return res
+
+    if helper.is_requesting_json(request) is False:
+        return {"Error": constants.error_406_json}, 406
+
+    sub = verify_helper.get_sub(request)
+
+    if sub is None or helper.sub_matches_user(client, sub) is False:
+        return {"Error": constants.error_401_bad_jwt}, 401
+
+    # { next: link to next page,
+    #   count: 3,
+    #   books: [{book1}, {book2}, {book3}] }
+    books, status = helper.get_library_book_page(client, request, library_id, sub)
+    return json.dumps(books), status
+
+
+# Moves many books in or out of the library in one call.  See helper.shelve_books for the body.
+@bp.route('/<library_id>/books:batch', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
+def libraries_books_batch(library_id):
+
+    if request.method != "POST":
+
+        res = make_response(json.dumps({"Error": constants.error_405_bad_method}))
+        res.mime_type = "application/json"
+        res.status_code = 405
+        res.headers.set("Allow", ["POST"])
+        return res
+
+    if helper.is_requesting_json(request) is False:
+        return {"Error": constants.error_406_json}, 406
+
+    sub = verify_helper.get_sub(request)
+
+    if sub is None or helper.sub_matches_user(client, sub) is False:
+        return {"Error": constants.error_401_bad_jwt}, 401
+
+    results, status = helper.shelve_books(client, request, library_id, sub)
+    return json.dumps(results), status
+
+
 @bp.route('/<library_id>/books/<book_id>', methods=['POST', 'GET', 'PUT', 'PATCH', 'DELETE'])
 def libraries_books_put_delete(library_id, book_id):
 
@@ -1,16 +1,14 @@
 # Started this code off the files we were allowed to use.
-from google.cloud import datastore
-from flask import Flask, request, url_for, render_template
-from requests_oauthlib import OAuth2Session
-import json
+from flask import Flask, Response, request, url_for, render_template
 from google.oauth2 import id_token
-from google.auth import crypt
-from google.auth import jwt
 from google.auth.transport import requests
 
 import library
-import random
+import entity_cache
 import helper
+import metrics
+import principal
+import storage
 import verify_helper
 import config
 import user
@@ -21,11 +19,13 @@ import os
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
 app = Flask(__name__)
+metrics.init_app(app)
 app.register_blueprint(library.bp)
 app.register_blueprint(user.bp)
 app.register_blueprint(book.bp)
+app.register_blueprint(book.batch_bp)
 
-client = datastore.Client()
+client = storage.get_client()
 
 # These should be copied from an OAuth2 Credential section at
 # https://console.cloud.google.com/apis/credentials
@@ -36,29 +36,35 @@ client_secret = config.client_secret
 # the Google authentication flow
 redirect_uri = config.redirect_uri
 
-random.seed()
-
 # These let us get basic info to identify a user and not much else
 # they are part of the Google People API
 scope = ['https://www.googleapis.com/auth/userinfo.email', 'https://www.googleapis.com/auth/userinfo.profile', 'openid']
-oauth = OAuth2Session(client_id, redirect_uri=redirect_uri, scope=scope)
+oauth = None
 
-# This link will redirect users to begin the OAuth flow with Google
-@app.route('/')
-def index():
 
-    state = "SimpleSecret" + str(random.randint(10000, 100000000))
+# Only the login pages need the OAuth session, so it and requests_oauthlib are loaded the first time one of them runs
+# instead of on every cold start.
+def get_oauth():
 
-    while True:
+    global oauth
 
-        if not verify_helper.state_exists(client, state):
-            break
+    if oauth is None:
 
-        state = "SimpleSecret" + str(random.randint(10000, 100000000))
+        from requests_oauthlib import OAuth2Session
 
-    verify_helper.store_state(client, state)
+        oauth = OAuth2Session(client_id, redirect_uri=redirect_uri, scope=scope)
 
-    authorization_url, state = oauth.authorization_url(
+    return oauth
+
+
+# This link will redirect users to begin the OAuth flow with Google
+@app.route('/')
+def index():
+
+    # The state is signed rather than stored, so starting a login doesn't touch Datastore.
+    state = verify_helper.create_state()
+
+    authorization_url, state = get_oauth().authorization_url(
         'https://accounts.google.com/o/oauth2/auth',
         # access_type and prompt are Google specific extra
         # parameters.
@@ -74,10 +80,10 @@ def oauthroute():
     state = request.args["state"]
     print(state)
 
-    if not verify_helper.state_exists(client, state):
+    if not verify_helper.check_state(state):
         return {"Error": "The state returned was incorrect."}, 400
 
-    token = oauth.fetch_token(
+    token = get_oauth().fetch_token(
         'https://accounts.google.com/o/oauth2/token',
         authorization_response=request.url,
         client_secret=client_secret)
@@ -100,10 +106,45 @@ def oauthroute():
         # helper.create_user(client, request, {"unique_id": id_info["sub"]})
         helper.create_user(client, request, payload)
 
-    verify_helper.delete_state(client, state)
-
     return render_template("user_info.html", token=token['id_token'], sub=id_info['sub'])
 
 
+# App Engine sends this to a new instance before routing traffic to it (inbound_services: warmup in app.yaml).
+# Opening the Datastore channel and fetching Google's signing certificates here keeps them off the first user's
+# request.
+@app.route('/_ah/warmup')
+def warmup():
+
+    storage.warm_up()
+
+    # If Google can't be reached now, the first token check fetches the certificates instead.
+    try:
+        verify_helper.cert_fetcher.get_certs()
+
+    except Exception:
+        pass
+
+    return "", 200
+
+
+# Hit and miss counters for the in-process caches, for scraping by monitoring.
+@app.route('/_stats')
+def stats():
+
+    return {"token_cache": verify_helper.token_cache.stats(),
+            "principal_cache": principal.principal_cache.stats(),
+            "entity_cache": entity_cache.stats()}
+
+
+# Request latency and Datastore RPC metrics per route, plus the cache counters, for Prometheus to scrape.
+@app.route('/_metrics')
+def metrics_route():
+
+    # entity_cache has the same stats() as a TTLCache.
+    caches = {"token": verify_helper.token_cache, "principal": principal.principal_cache, "entity": entity_cache}
+
+    return Response(metrics.render(caches), mimetype="text/plain; version=0.0.4")
+
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
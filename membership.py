@@ -0,0 +1,105 @@
+# Keeps track of which books are in which library and which libraries belong to which user.
+#
+# In the embedded mode (the default) every library stores a "books" list and every user a "libraries" list, and
+# both sides are written whenever one changes.  Those lists grow with the collection, every append rewrites the
+# whole entity, and Datastore's 1 MiB entity limit caps how big a library can get.
+#
+# In the indexed mode the lists aren't stored.  A library's books are the books whose library.id points at it and a
+# user's libraries are the libraries whose librarian.id points at them, both found with indexed queries.  Putting a
+# book in a library is then one small write to the book.  Set MEMBERSHIP_MODE=indexed to use it, after running
+# migrate_membership.py over any existing data.
+
+import os
+import constants
+import queries
+
+embedded = "embedded"
+indexed = "indexed"
+
+mode = os.environ.get("MEMBERSHIP_MODE", embedded)
+
+
+def is_indexed():
+
+    return mode == indexed
+
+
+# Returns the ids (as strings) of every library the user owns.
+def get_owned_library_ids(dsClient, user):
+
+    if is_indexed():
+
+        library_keys = queries.get_keys_where(dsClient, constants.libraries, "librarian.id", user.key.id)
+
+        return [str(key.id) for key in library_keys]
+
+    return [str(library["id"]) for library in user["libraries"]]
+
+
+# Returns the keys of every book in the library.
+def get_book_keys(dsClient, library):
+
+    if is_indexed():
+
+        return queries.get_keys_where(dsClient, constants.books, "library.id", str(library.key.id))
+
+    return [dsClient.key(constants.books, int(book["id"])) for book in library["books"]]
+
+
+# Records that a book was put in the library.  Returns true if the library entity changed and needs to be written.
+def add_book(library, book_id):
+
+    if is_indexed():
+
+        return False
+
+    library["books"].append({"id": str(book_id)})
+
+    return True
+
+
+# Records that a book was taken out of the library.  Returns true if the library entity changed and needs to be
+# written.
+def remove_book(library, book_id):
+
+    if is_indexed():
+
+        return False
+
+    return remove_by_id(library["books"], book_id)
+
+
+# Records that the user owns a new library.  Returns true if the user entity changed and needs to be written.
+def add_library(user, library_id):
+
+    if is_indexed():
+
+        return False
+
+    user["libraries"].append({"id": str(library_id)})
+
+    return True
+
+
+# Records that the user no longer owns the library.  Returns true if the user entity changed and needs to be written.
+def remove_library(user, library_id):
+
+    if is_indexed():
+
+        return False
+
+    return remove_by_id(user["libraries"], library_id)
+
+
+# Removes the reference with this id from a list of references.  Returns true if one was removed.
+def remove_by_id(references, id):
+
+    # https://www.geeksforgeeks.org/python-removing-dictionary-from-list-of-dictionaries/
+    # https://docs.python.org/3/library/stdtypes.html#range
+    for i in range(len(references)):
+
+        if references[i]["id"] == str(id):
+            del references[i]
+            return True
+
+    return False
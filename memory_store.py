@@ -0,0 +1,510 @@
+# An in-memory storage engine that stands in for google.cloud.datastore.Client.  It implements the part of the
+# client API that helper.py and the blueprints use (keys, get/put/delete and their _multi forms, filtered and
+# ordered queries with cursors, keys-only queries and transactions), so the whole app runs against it unchanged.
+# Equality filters are answered from hash indexes instead of scanning the whole kind.
+
+import base64
+import copy
+import itertools
+import threading
+from google.cloud.datastore.entity import Entity
+from google.cloud.datastore.key import Key
+import constants
+
+# The properties every request filters on get a hash index from the start.  Any other property gets one the first
+# time it is used in an equality filter.
+indexed_properties = [(constants.users, "unique_id"),
+                      (constants.libraries, "librarian.id"),
+                      (constants.books, "library.id"),
+                      (constants.books, "shelved"),
+                      (constants.books, "search_terms"),
+                      (constants.books, "title_terms"),
+                      (constants.books, "author_terms")]
+
+
+# Returns the value of a property, following dotted names into embedded entities.  Returns None if missing.
+def get_property(entity, name):
+
+    value = entity
+
+    for part in name.split("."):
+
+        if not isinstance(value, dict) or part not in value:
+            return None
+
+        value = value[part]
+
+    return value
+
+
+# Hash indexes can only hold hashable values.  Embedded entities are left out of them.
+def is_hashable(value):
+
+    return not isinstance(value, (dict, list))
+
+
+# Returns the values an entity is indexed under for a property.  Like Datastore, a list is indexed under each of
+# its values.
+def get_index_values(entity, name):
+
+    value = get_property(entity, name)
+
+    if isinstance(value, list):
+        return [v for v in value if is_hashable(v)]
+
+    if is_hashable(value):
+        return [value]
+
+    return []
+
+
+# Returns true if the entity has the property at all, even if its value is None.
+def has_property(entity, name):
+
+    parent, _, last = name.rpartition(".")
+
+    if parent:
+        entity = get_property(entity, parent)
+
+    return isinstance(entity, dict) and last in entity
+
+
+def sort_value(value):
+
+    # None sorts first, the same as Datastore's null ordering.
+    if value is None:
+        return (0, 0)
+
+    if isinstance(value, bool):
+        return (1, value)
+
+    if isinstance(value, (int, float)):
+        return (2, value)
+
+    if isinstance(value, str):
+        return (3, value)
+
+    return (4, str(value))
+
+
+class MemoryClient:
+
+    def __init__(self, project="memory", namespace=None):
+
+        self.project = project
+        self.namespace = namespace
+
+        # kind -> {id_or_name: entity}
+        self._kinds = {}
+        # (kind, property) -> {value: set of ids}
+        self._indexes = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+        for kind, name in indexed_properties:
+            self._get_index(kind, name)
+
+        # How many calls of each kind were made, the way they would be counted as Datastore RPCs.
+        self.rpc_counts = {"get": 0, "put": 0, "delete": 0, "query": 0}
+
+    def key(self, *path_args, **kwargs):
+
+        kwargs.setdefault("project", self.project)
+        kwargs.setdefault("namespace", self.namespace)
+
+        return Key(*path_args, **kwargs)
+
+    def query(self, **kwargs):
+
+        return MemoryQuery(self, **kwargs)
+
+    def transaction(self, **kwargs):
+
+        return MemoryTransaction(self)
+
+    def batch(self):
+
+        return MemoryTransaction(self)
+
+    def allocate_ids(self, incomplete_key, num_ids):
+
+        return [incomplete_key.completed_key(next(self._ids)) for _ in range(num_ids)]
+
+    def get(self, key, missing=None, deferred=None, transaction=None, eventual=False):
+
+        entities = self.get_multi([key], missing=missing)
+
+        if len(entities) == 0:
+            return None
+
+        return entities[0]
+
+    def get_multi(self, keys, missing=None, deferred=None, transaction=None, eventual=False):
+
+        found = []
+
+        with self._lock:
+
+            self.rpc_counts["get"] += 1
+
+            for key in keys:
+
+                entity = self._kinds.get(key.kind, {}).get(key.id_or_name)
+
+                if entity is None:
+
+                    if missing is not None:
+                        missing.append(Entity(key=key))
+
+                    continue
+
+                found.append(copy.deepcopy(entity))
+
+        return found
+
+    def put(self, entity):
+
+        self.put_multi([entity])
+
+    # Like the real client, writes made inside a transaction's with block are held until it commits.
+    @property
+    def current_transaction(self):
+
+        return getattr(self._local, "transaction", None)
+
+    def put_multi(self, entities):
+
+        if self.current_transaction is not None:
+
+            self.current_transaction.put_multi(entities)
+            return
+
+        with self._lock:
+
+            self.rpc_counts["put"] += 1
+
+            for entity in entities:
+
+                if entity.key.is_partial:
+                    entity.key = entity.key.completed_key(next(self._ids))
+
+                kind = self._kinds.setdefault(entity.key.kind, {})
+                old = kind.get(entity.key.id_or_name)
+
+                if old is not None:
+                    self._unindex(old)
+
+                stored = copy.deepcopy(entity)
+                kind[entity.key.id_or_name] = stored
+                self._index(stored)
+
+    def delete(self, key):
+
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+
+        if self.current_transaction is not None:
+
+            for key in keys:
+                self.current_transaction.delete(key)
+
+            return
+
+        with self._lock:
+
+            self.rpc_counts["delete"] += 1
+
+            for key in keys:
+
+                old = self._kinds.get(key.kind, {}).pop(key.id_or_name, None)
+
+                if old is not None:
+                    self._unindex(old)
+
+    def _index(self, entity):
+
+        for (kind, name), index in self._indexes.items():
+
+            if kind == entity.key.kind:
+
+                for value in get_index_values(entity, name):
+                    index.setdefault(value, set()).add(entity.key.id_or_name)
+
+    def _unindex(self, entity):
+
+        for (kind, name), index in self._indexes.items():
+
+            if kind == entity.key.kind:
+
+                for value in get_index_values(entity, name):
+
+                    if value not in index:
+                        continue
+
+                    index[value].discard(entity.key.id_or_name)
+
+                    if len(index[value]) == 0:
+                        del index[value]
+
+    # Returns the hash index for a property of a kind, building it on first use.
+    def _get_index(self, kind, name):
+
+        index = self._indexes.get((kind, name))
+
+        if index is None:
+
+            index = {}
+
+            for entity in self._kinds.get(kind, {}).values():
+
+                for value in get_index_values(entity, name):
+                    index.setdefault(value, set()).add(entity.key.id_or_name)
+
+            self._indexes[(kind, name)] = index
+
+        return index
+
+    # Returns every entity of the query's kind that passes its filters, in the query's order.
+    def _run_query(self, query):
+
+        with self._lock:
+
+            self.rpc_counts["query"] += 1
+
+            entities = self._kinds.get(query.kind, {})
+            candidates = None
+
+            # Narrow the candidates with an equality filter, using the key itself or the smallest matching hash
+            # index, the way Datastore starts a merge join from its most selective index.
+            ids = None
+
+            for name, op, value in query.filters:
+
+                if op == "=" and name == "__key__":
+
+                    entity = entities.get(value.id_or_name) if value.kind == query.kind else None
+                    candidates = [entity] if entity is not None else []
+                    break
+
+                if op == "=" and is_hashable(value):
+
+                    matching = self._get_index(query.kind, name).get(value, ())
+
+                    if ids is None or len(matching) < len(ids):
+                        ids = matching
+
+            if candidates is None and ids is not None:
+                candidates = [entities[i] for i in ids]
+
+            if candidates is None:
+                candidates = list(entities.values())
+
+            if len(query.filters) != 0:
+                results = [e for e in candidates if query.matches(e)]
+            else:
+                results = candidates
+
+        order = list(query.order) or ["__key__"]
+
+        # Sort on the least significant order first so each earlier sort takes priority.
+        for name in reversed(order):
+
+            descending = name.startswith("-")
+            name = name.lstrip("-")
+
+            if name == "__key__":
+                # key.id_or_name copies the key's path every time it's read.  flat_path ends with the same value and
+                # isn't copied.
+                results.sort(key=lambda e: sort_value(e.key.flat_path[-1]), reverse=descending)
+            else:
+                # Entities without the property aren't in its index, so an ordered query leaves them out.
+                results = [e for e in results if has_property(e, name)]
+                results.sort(key=lambda e: sort_value(get_property(e, name)), reverse=descending)
+
+        return results
+
+
+class MemoryQuery:
+
+    def __init__(self, client, kind=None, filters=(), projection=(), order=(), distinct_on=(), ancestor=None,
+                 namespace=None, project=None):
+
+        self._client = client
+        self.kind = kind
+        self.filters = list(filters)
+        self.projection = list(projection)
+        self.order = list(order)
+        self.ancestor = ancestor
+
+    def add_filter(self, property_name, operator, value):
+
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+
+        self.projection = ["__key__"]
+
+    def matches(self, entity):
+
+        for name, op, value in self.filters:
+
+            if name == "__key__":
+                actual = entity.key
+            else:
+                actual = get_property(entity, name)
+
+            if op == "=":
+
+                if isinstance(actual, list):
+                    if value not in actual:
+                        return False
+
+                elif actual != value:
+                    return False
+
+                continue
+
+            if actual is None or type(actual) != type(value):
+                return False
+
+            if op == "<" and not actual < value:
+                return False
+            if op == "<=" and not actual <= value:
+                return False
+            if op == ">" and not actual > value:
+                return False
+            if op == ">=" and not actual >= value:
+                return False
+
+        return True
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, end_cursor=None, client=None, eventual=False):
+
+        return MemoryIterator(self, limit, offset, start_cursor)
+
+
+class MemoryIterator:
+
+    def __init__(self, query, limit, offset, start_cursor):
+
+        self._query = query
+        self._limit = limit
+        self._offset = offset or 0
+        self._start = 0
+        self.next_page_token = None
+
+        if start_cursor is not None:
+
+            if isinstance(start_cursor, bytes):
+                start_cursor = start_cursor.decode("ascii")
+
+            self._start = int(base64.urlsafe_b64decode(start_cursor.encode("ascii")))
+
+        self._consumed = False
+
+    def _run(self):
+
+        results = self._query._client._run_query(self._query)
+        begin = self._start + self._offset
+
+        if self._limit is None:
+            end = len(results)
+        else:
+            end = min(len(results), begin + self._limit)
+
+        page = results[begin:end]
+
+        if self._limit is not None and end < len(results):
+            self.next_page_token = base64.urlsafe_b64encode(str(end).encode("ascii"))
+        else:
+            self.next_page_token = None
+
+        self._consumed = True
+
+        if self._query.projection == ["__key__"]:
+            return [Entity(key=e.key) for e in page]
+
+        if len(self._query.projection) > 0:
+
+            projected = []
+
+            for e in page:
+
+                p = Entity(key=e.key)
+
+                for name in self._query.projection:
+                    p[name] = get_property(e, name)
+
+                projected.append(p)
+
+            return projected
+
+        return [copy.deepcopy(e) for e in page]
+
+    @property
+    def pages(self):
+
+        if not self._consumed:
+            yield iter(self._run())
+
+    def __iter__(self):
+
+        for page in self.pages:
+
+            for entity in page:
+                yield entity
+
+
+# Transactions apply their writes together when the with block exits.  Writes are serialized by the client's
+# lock, so there is never contention to report.
+class MemoryTransaction:
+
+    def __init__(self, client):
+
+        self._client = client
+        self._puts = []
+        self._deletes = []
+        self.id = None
+
+    def __enter__(self):
+
+        self._client._lock.acquire()
+        self._client._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self._client._local.transaction = None
+
+        try:
+
+            if exc_type is None:
+
+                if self._puts:
+                    self._client.put_multi(self._puts)
+
+                if self._deletes:
+                    self._client.delete_multi(self._deletes)
+
+        finally:
+
+            self._client._lock.release()
+
+    def put(self, entity):
+
+        if entity.key.is_partial:
+            entity.key = entity.key.completed_key(next(self._client._ids))
+
+        self._puts.append(entity)
+
+    def put_multi(self, entities):
+
+        for entity in entities:
+            self.put(entity)
+
+    def delete(self, key):
+
+        self._deletes.append(key)
@@ -0,0 +1,387 @@
+# Per-request Datastore instrumentation and request metrics.
+#
+# InstrumentedClient wraps the storage client and records how many get/put/delete/query/commit calls each request
+# makes and how long they take.  The totals are kept on flask.g, sent back in a Server-Timing header, and logged as a
+# single JSON line when a request takes longer than SLOW_REQUEST_MS.  Every request's duration and RPCs also go into
+# per-route histograms and counters, which /_metrics serves in the Prometheus text format.
+
+import json
+import logging
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+import constants
+
+slow_request_ms = float(os.environ.get("SLOW_REQUEST_MS", constants.slow_request_ms))
+
+logger = logging.getLogger("slow_requests")
+
+
+# Adds one call of op that took seconds to the current request's totals.
+def record_rpc(op, seconds):
+
+    if not has_request_context():
+        return
+
+    if "rpc_stats" not in g:
+        g.rpc_stats = {}
+
+    count, total = g.rpc_stats.get(op, (0, 0.0))
+    g.rpc_stats[op] = (count + 1, total + seconds)
+
+
+# Adds RPC totals recorded in another thread (see concurrency.py) to the current request's.
+def add_rpc_stats(stats):
+
+    if not has_request_context():
+        return
+
+    if "rpc_stats" not in g:
+        g.rpc_stats = {}
+
+    for op, (count, seconds) in stats.items():
+
+        total_count, total_seconds = g.rpc_stats.get(op, (0, 0.0))
+        g.rpc_stats[op] = (total_count + count, total_seconds + seconds)
+
+
+# Wraps a Datastore client (or memory_store.MemoryClient) and records every call that reaches the backend.
+# Writes made inside a transaction are only sent when it commits, so they are counted as part of the commit.
+class InstrumentedClient:
+
+    def __init__(self, client):
+
+        self._client = client
+
+    def __getattr__(self, name):
+
+        return getattr(self._client, name)
+
+    def _timed(self, op, func, *args, **kwargs):
+
+        start = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+
+        finally:
+            record_rpc(op, time.perf_counter() - start)
+
+    def _in_transaction(self):
+
+        return self._client.current_transaction is not None
+
+    def get(self, key, *args, **kwargs):
+
+        return self._timed("get", self._client.get, key, *args, **kwargs)
+
+    def get_multi(self, keys, *args, **kwargs):
+
+        return self._timed("get", self._client.get_multi, keys, *args, **kwargs)
+
+    def put(self, entity):
+
+        if self._in_transaction():
+            return self._client.put(entity)
+
+        return self._timed("put", self._client.put, entity)
+
+    def put_multi(self, entities):
+
+        if self._in_transaction():
+            return self._client.put_multi(entities)
+
+        return self._timed("put", self._client.put_multi, entities)
+
+    def delete(self, key):
+
+        if self._in_transaction():
+            return self._client.delete(key)
+
+        return self._timed("delete", self._client.delete, key)
+
+    def delete_multi(self, keys):
+
+        if self._in_transaction():
+            return self._client.delete_multi(keys)
+
+        return self._timed("delete", self._client.delete_multi, keys)
+
+    def query(self, **kwargs):
+
+        return InstrumentedQuery(self._client.query(**kwargs))
+
+    def transaction(self, **kwargs):
+
+        return InstrumentedTransaction(self._client.transaction(**kwargs))
+
+
+class InstrumentedQuery:
+
+    def __init__(self, query):
+
+        self._query = query
+
+    def __getattr__(self, name):
+
+        return getattr(self._query, name)
+
+    # Settings like query.order and query.projection belong to the wrapped query.
+    def __setattr__(self, name, value):
+
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+
+        return InstrumentedIterator(self._query.fetch(*args, **kwargs))
+
+
+# Every page a query iterator pulls is one query RPC.
+class InstrumentedIterator:
+
+    def __init__(self, iterator):
+
+        self._iterator = iterator
+
+    def __getattr__(self, name):
+
+        return getattr(self._iterator, name)
+
+    @property
+    def pages(self):
+
+        pages = self._iterator.pages
+
+        while True:
+
+            start = time.perf_counter()
+
+            try:
+                page = next(pages)
+
+            except StopIteration:
+                return
+
+            record_rpc("query", time.perf_counter() - start)
+
+            yield page
+
+    def __iter__(self):
+
+        for page in self.pages:
+
+            for entity in page:
+                yield entity
+
+
+# Beginning and committing a transaction are counted together as one commit.
+class InstrumentedTransaction:
+
+    def __init__(self, transaction):
+
+        self._transaction = transaction
+
+    def __getattr__(self, name):
+
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+
+        start = time.perf_counter()
+        self._transaction.__enter__()
+        self._elapsed = time.perf_counter() - start
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        start = time.perf_counter()
+
+        try:
+            return self._transaction.__exit__(exc_type, exc_value, traceback)
+
+        finally:
+            record_rpc("commit", self._elapsed + time.perf_counter() - start)
+
+
+# A Prometheus histogram with one series per label set.
+class Histogram:
+
+    def __init__(self, name, help_text, buckets):
+
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+
+        # labels -> [bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+
+        with self._lock:
+
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+
+            for i, bound in enumerate(self.buckets):
+
+                if value <= bound:
+                    series[i] += 1
+
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " histogram"]
+
+        with self._lock:
+
+            for labels, series in sorted(self._series.items()):
+
+                for bound, count in zip(self.buckets, series):
+                    lines.append(self.name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " "
+                                 + str(count))
+
+                lines.append(self.name + "_bucket" + format_labels(labels + (("le", "+Inf"),)) + " "
+                             + str(series[-1]))
+                lines.append(self.name + "_sum" + format_labels(labels) + " " + repr(series[-2]))
+                lines.append(self.name + "_count" + format_labels(labels) + " " + str(series[-1]))
+
+        return lines
+
+
+# A Prometheus counter with one series per label set.
+class Counter:
+
+    def __init__(self, name, help_text):
+
+        self.name = name
+        self.help_text = help_text
+
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, value=1):
+
+        with self._lock:
+
+            self._series[labels] = self._series.get(labels, 0) + value
+
+    def set(self, labels, value):
+
+        with self._lock:
+
+            self._series[labels] = value
+
+    def render(self, kind="counter"):
+
+        lines = ["# HELP " + self.name + " " + self.help_text, "# TYPE " + self.name + " " + kind]
+
+        with self._lock:
+
+            for labels, value in sorted(self._series.items()):
+                lines.append(self.name + format_labels(labels) + " " + repr(value))
+
+        return lines
+
+
+def format_labels(labels):
+
+    if len(labels) == 0:
+        return ""
+
+    escaped = [name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels]
+
+    return "{" + ",".join(escaped) + "}"
+
+
+request_duration = Histogram("http_request_duration_seconds", "Time spent handling requests, by route.",
+                             constants.latency_buckets)
+request_rpcs = Histogram("datastore_rpcs_per_request", "Datastore RPCs made by each request, by route.",
+                         constants.rpc_count_buckets)
+rpc_duration = Counter("datastore_rpc_seconds_total", "Time spent waiting on Datastore, by route and call.")
+rpc_calls = Counter("datastore_rpcs_total", "Datastore RPCs made, by route and call.")
+
+
+def start_request():
+
+    g.request_start = time.perf_counter()
+    g.rpc_stats = {}
+
+
+# Adds the Server-Timing header, records the request in the metrics and logs it if it was slow.
+def finish_request(response):
+
+    if "request_start" not in g:
+        return response
+
+    elapsed = time.perf_counter() - g.request_start
+    stats = g.get("rpc_stats", {})
+
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    labels = (("route", route), ("method", request.method))
+
+    rpc_count = sum(count for count, seconds in stats.values())
+    rpc_seconds = sum(seconds for count, seconds in stats.values())
+
+    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Server-Timing
+    timings = ['datastore;desc="rpcs=%d";dur=%.2f' % (rpc_count, rpc_seconds * 1000)]
+
+    for op, (count, seconds) in sorted(stats.items()):
+
+        timings.append('datastore-%s;desc="rpcs=%d";dur=%.2f' % (op, count, seconds * 1000))
+        rpc_calls.inc(labels + (("op", op),), count)
+        rpc_duration.inc(labels + (("op", op),), seconds)
+
+    timings.append("total;dur=%.2f" % (elapsed * 1000))
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    request_duration.observe(labels, elapsed)
+    request_rpcs.observe(labels, rpc_count)
+
+    if elapsed * 1000 > slow_request_ms:
+
+        logger.warning(json.dumps({
+            "message": "slow request",
+            "method": request.method,
+            "path": request.path,
+            "route": route,
+            "status": response.status_code,
+            "duration_ms": round(elapsed * 1000, 2),
+            "datastore_ms": round(rpc_seconds * 1000, 2),
+            "rpcs": {op: {"count": count, "ms": round(seconds * 1000, 2)} for op, (count, seconds) in stats.items()},
+        }, sort_keys=True))
+
+    return response
+
+
+# Returns every metric in the Prometheus text exposition format.  caches maps a name to a cache.TTLCache whose
+# counters should be included.
+def render(caches):
+
+    cache_counts = Counter("cache_requests_total", "Cache lookups, by cache and result.")
+    cache_sizes = Counter("cache_entries", "Entries held, by cache.")
+
+    for name, cache in caches.items():
+
+        stats = cache.stats()
+        cache_counts.set((("cache", name), ("result", "hit")), stats["hits"])
+        cache_counts.set((("cache", name), ("result", "miss")), stats["misses"])
+        cache_sizes.set((("cache", name),), stats["size"])
+
+    lines = request_duration.render() + request_rpcs.render() + rpc_calls.render() + rpc_duration.render()
+    lines += cache_counts.render() + cache_sizes.render("gauge")
+
+    return "\n".join(lines) + "\n"
+
+
+# Hooks the instrumentation into the app.
+def init_app(app):
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
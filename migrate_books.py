@@ -0,0 +1,108 @@
+# Fills in the fields that newer code keeps on every book, for books written before it did.
+#
+#   python migrate_books.py             # run before deploying code that filters or sorts on the field
+#   python migrate_books.py --dry-run   # only report how many books would change
+#
+# Fields filled in:
+#   title_lower  - the lowercase title that GET /books sorts on and matches title_prefix against.  Books without it
+#                  are left out of those queries.
+#   shelved      - whether the book is in a library, for GET /books?shelved=.  Books without it match neither value.
+#   search_terms, title_terms, title_words, author_terms, author_words
+#                - what GET /books/search finds and ranks the book by (see search.py).  Books without them are never
+#                  found.
+#
+# Books are read batch_size at a time.  Each batch's changes are written in a transaction that reads the books again,
+# so a book changed by the API while the migration runs isn't overwritten with an old copy.  Running it twice is
+# harmless: books that are already up to date aren't written.
+
+import argparse
+from google.cloud import datastore
+import constants
+import helper
+import search
+import transactions
+from migrate_membership import get_batches
+
+
+# Returns the fields the book is missing or has out of date.
+def get_changes(book):
+
+    changes = {}
+
+    # Books written before titles were checked can have a title that isn't a string.  They get no title_lower, like
+    # search.get_words gives them no words, but still get the rest.
+    title = book.get("title")
+
+    if isinstance(title, str) and book.get("title_lower") != title.lower():
+        changes["title_lower"] = title.lower()
+
+    shelved = book.get("library") is not None
+
+    if book.get("shelved") != shelved:
+        changes["shelved"] = shelved
+
+    indexed = dict(book)
+    search.index_book(indexed)
+
+    for field in search.index_fields:
+
+        if book.get(field) != indexed[field]:
+            changes[field] = indexed[field]
+
+    return changes
+
+
+# Writes the changes to the books with these keys.  Returns how many were changed.
+def update_books(client, keys):
+
+    def update():
+
+        books = [book for book in helper.get_entities(client, keys) if book is not None]
+        changed = []
+
+        for book in books:
+
+            changes = get_changes(book)
+
+            if len(changes) != 0:
+
+                book.update(changes)
+                changed.append(book)
+
+        if len(changed) != 0:
+            client.put_multi(changed)
+
+        return len(changed)
+
+    return transactions.run_in_transaction(client, update)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Fill in fields missing from existing books.")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    client = datastore.Client()
+
+    books_checked = 0
+    books_changed = 0
+
+    for books in get_batches(client, constants.books):
+
+        books_checked += len(books)
+        keys = [book.key for book in books if len(get_changes(book)) != 0]
+
+        if len(keys) == 0:
+            continue
+
+        if args.dry_run:
+            books_changed += len(keys)
+        else:
+            books_changed += update_books(client, keys)
+
+    print("books checked: %d  changed: %d" % (books_checked, books_changed))
+
+
+if __name__ == "__main__":
+    main()
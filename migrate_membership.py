@@ -0,0 +1,171 @@
+# Moves existing data between the embedded and indexed membership modes described in membership.py.
+#
+#   python migrate_membership.py --to indexed     # run before deploying with MEMBERSHIP_MODE=indexed
+#   python migrate_membership.py --to embedded    # run before switching back
+#
+# Going to indexed, every book listed by a library is checked to point back at it (books that point nowhere are
+# repaired, books that point at another library are reported), and then the libraries' "books" lists and the users'
+# "libraries" lists are dropped.  Going to embedded, the lists are rebuilt from the books' library.id and the
+# libraries' librarian.id.  Entities are read and written in batches of batch_size.  Add --dry-run to only report.
+
+import argparse
+from google.cloud import datastore
+import constants
+import helper
+
+
+# Yields every entity of a kind, one batch at a time.
+def get_batches(client, kind):
+
+    cursor = None
+
+    while True:
+
+        query = client.query(kind=kind)
+        iterator = query.fetch(limit=constants.batch_size, start_cursor=cursor)
+        batch = list(next(iterator.pages))
+
+        if len(batch) == 0:
+            return
+
+        yield batch
+
+        cursor = iterator.next_page_token
+
+        if cursor is None or len(batch) < constants.batch_size:
+            return
+
+
+# Returns the ids (as strings) of the entities of kind whose property matches value, using only keys.
+def get_ids_where(client, kind, property_name, value):
+
+    query = client.query(kind=kind)
+    query.add_filter(property_name, "=", value)
+    query.keys_only()
+
+    return [str(entity.key.id) for entity in query.fetch()]
+
+
+def write(client, entities, dry_run):
+
+    if dry_run:
+        return
+
+    for chunk in helper.get_chunks(entities, constants.batch_size):
+        client.put_multi(chunk)
+
+
+def to_indexed(client, dry_run):
+
+    libraries_changed = 0
+    users_changed = 0
+    books_repaired = 0
+
+    for libraries in get_batches(client, constants.libraries):
+
+        changed = []
+
+        for library in libraries:
+
+            if "books" not in library:
+                continue
+
+            library_id = str(library.key.id)
+            book_keys = [client.key(constants.books, int(book["id"])) for book in library["books"]]
+            repaired = []
+
+            for chunk in helper.get_chunks(book_keys, constants.batch_size):
+
+                for book in client.get_multi(chunk):
+
+                    if book["library"] is None:
+
+                        helper.set_library(book, library_id)
+                        repaired.append(book)
+
+                    elif book["library"]["id"] != library_id:
+
+                        print("book %s is listed by library %s but points at library %s; left as is"
+                              % (book.key.id, library_id, book["library"]["id"]))
+
+            write(client, repaired, dry_run)
+            books_repaired += len(repaired)
+
+            del library["books"]
+            changed.append(library)
+
+        write(client, changed, dry_run)
+        libraries_changed += len(changed)
+
+    for users in get_batches(client, constants.users):
+
+        changed = []
+
+        for user in users:
+
+            if "libraries" not in user:
+                continue
+
+            owned = set(get_ids_where(client, constants.libraries, "librarian.id", user.key.id))
+
+            for library in user["libraries"]:
+
+                if str(library["id"]) not in owned:
+
+                    print("user %s lists library %s, which has a different librarian; dropped"
+                          % (user.key.id, library["id"]))
+
+            del user["libraries"]
+            changed.append(user)
+
+        write(client, changed, dry_run)
+        users_changed += len(changed)
+
+    print("libraries: %d  users: %d  books repaired: %d" % (libraries_changed, users_changed, books_repaired))
+
+
+def to_embedded(client, dry_run):
+
+    libraries_changed = 0
+    users_changed = 0
+
+    for libraries in get_batches(client, constants.libraries):
+
+        for library in libraries:
+
+            book_ids = get_ids_where(client, constants.books, "library.id", str(library.key.id))
+            library["books"] = [{"id": book_id} for book_id in book_ids]
+
+        write(client, libraries, dry_run)
+        libraries_changed += len(libraries)
+
+    for users in get_batches(client, constants.users):
+
+        for user in users:
+
+            library_ids = get_ids_where(client, constants.libraries, "librarian.id", user.key.id)
+            user["libraries"] = [{"id": library_id} for library_id in library_ids]
+
+        write(client, users, dry_run)
+        users_changed += len(users)
+
+    print("libraries: %d  users: %d" % (libraries_changed, users_changed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Move library and user membership between storage modes.")
+    parser.add_argument("--to", choices=["indexed", "embedded"], required=True)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    client = datastore.Client()
+
+    if args.to == "indexed":
+        to_indexed(client, args.dry_run)
+    else:
+        to_embedded(client, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
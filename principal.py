@@ -0,0 +1,132 @@
+# Resolves the user behind a request's JWT once per request.  The result is kept on flask.g so every helper that
+# needs the user, its id or the libraries it owns shares a single Datastore lookup.  Across requests the user id and
+# owned library ids are also kept in principal_cache, so most requests don't need a lookup at all.
+
+from flask import g, has_request_context
+import cache
+import constants
+import membership
+import verify_helper
+
+# sub -> (user id, frozenset of owned library ids).  Writes that change either go through Principal, which keeps
+# this up to date.  Other instances can be up to principal_cache_ttl seconds behind.
+principal_cache = cache.TTLCache(constants.principal_cache_size, default_ttl=constants.principal_cache_ttl)
+
+
+# The user making the request.  library_ids holds the ids (as strings) of every library the user owns.
+# The user entity itself is only fetched if a helper asks for it.
+class Principal:
+
+    def __init__(self, dsClient, sub, user_id, library_ids, user=None):
+
+        self.sub = sub
+        self.user_id = user_id
+        self.library_ids = set(library_ids)
+
+        self._dsClient = dsClient
+        self._user = user
+
+    @property
+    def user(self):
+
+        if self._user is None:
+
+            self._user = self._dsClient.get(key=self._dsClient.key(constants.users, self.user_id))
+
+        return self._user
+
+    def owns_library(self, library_id):
+
+        return str(library_id) in self.library_ids
+
+    def add_library(self, library_id):
+
+        self.library_ids.add(str(library_id))
+        remember(self)
+
+    def remove_library(self, library_id):
+
+        self.library_ids.discard(str(library_id))
+        remember(self)
+
+
+# Builds a Principal from the user found by find_user and records it in principal_cache.
+def from_user(dsClient, sub, user):
+
+    library_ids = membership.get_owned_library_ids(dsClient, user)
+
+    # In the indexed mode find_user only fetches the key, so the entity is loaded later if it's needed.
+    full_user = None if membership.is_indexed() else user
+
+    principal = Principal(dsClient, sub, user.key.id, library_ids, full_user)
+    remember(principal)
+
+    return principal
+
+
+def remember(principal):
+
+    principal_cache.set(principal.sub, (principal.user_id, frozenset(principal.library_ids)))
+
+
+# Returns the user entity whose unique_id matches sub, or None if there isn't one.  In the indexed membership mode
+# nothing but the user's key is needed, so only the key is fetched.
+def find_user(dsClient, sub):
+
+    query = dsClient.query(kind=constants.users)
+    query.add_filter("unique_id", "=", sub)
+
+    if membership.is_indexed():
+
+        query.keys_only()
+
+    results = list(query.fetch(limit=1))
+
+    if len(results) == 0:
+
+        return None
+
+    return results[0]
+
+
+# Returns the Principal for sub, or None if no user has that sub.  Inside a request the answer is stored on flask.g,
+# so repeated calls for the same sub don't go back to Datastore.
+def get_principal(dsClient, sub):
+
+    if has_request_context() and "principal_sub" in g and g.principal_sub == sub:
+
+        return g.principal
+
+    principal = None
+    cached = principal_cache.get(sub)
+
+    if cached is not None:
+
+        user_id, library_ids = cached
+        principal = Principal(dsClient, sub, user_id, library_ids)
+
+    else:
+
+        user = find_user(dsClient, sub)
+
+        if user is not None:
+
+            principal = from_user(dsClient, sub, user)
+
+    if has_request_context():
+
+        g.principal_sub = sub
+        g.principal = principal
+
+    return principal
+
+
+# Meant to be registered with before_request.  Resolves the request's JWT to a Principal up front so the view and
+# the helpers it calls all reuse it.  Requests without a valid JWT are left for the view to reject.
+def load_principal(dsClient, request):
+
+    sub = verify_helper.get_sub(request)
+
+    if sub is not None:
+
+        get_principal(dsClient, sub)
@@ -0,0 +1,28 @@
+# Existence checks that only ask Datastore for keys.  Nothing but a key comes back over the wire, so there are no
+# entities to transfer or deserialize just to learn that one exists.
+
+
+# Returns true if at least one entity of kindOfEntity has property_name equal to value.
+def entity_exists(dsClient, kindOfEntity, property_name, value):
+
+    query = dsClient.query(kind=kindOfEntity)
+    query.add_filter(property_name, "=", value)
+    query.keys_only()
+
+    return len(list(query.fetch(limit=1))) != 0
+
+
+# Returns true if an entity of kindOfEntity with this id exists.
+def key_exists(dsClient, kindOfEntity, id):
+
+    return entity_exists(dsClient, kindOfEntity, "__key__", dsClient.key(kindOfEntity, int(id)))
+
+
+# Returns the keys of the entities of kindOfEntity that have property_name equal to value, up to limit of them.
+def get_keys_where(dsClient, kindOfEntity, property_name, value, limit=None):
+
+    query = dsClient.query(kind=kindOfEntity)
+    query.add_filter(property_name, "=", value)
+    query.keys_only()
+
+    return [entity.key for entity in query.fetch(limit=limit)]
@@ -0,0 +1,147 @@
+# Full-text search over the book catalog.
+#
+# Every book keeps search_terms, the distinct lowercase words of its title, author and illustrator.  Datastore
+# indexes a list property under each of its values, so that index is the inverted index: the books with a word are
+# one equality filter away, and a book's entries change in the same write that changes the book.  index_book fills
+# search_terms in wherever a book's fields are written (get_new_book, update_entity and the batch patches), and
+# deleting a book drops its entries with it.
+#
+# A search matches the books that have every word of the query and ranks them by where the words appear.  Since every
+# match has every word, how rare a word is doesn't change the order, so only the matches themselves are needed to rank
+# them.
+#
+# A common word can match far more books than are worth ranking, so the candidates are gathered in tiers, each at most
+# search_candidate_limit books:
+#   1. books with every word in the title, shortest title first
+#   2. books with every word in the author, shortest author first
+#   3. any match, oldest first
+# Books also keep title_terms and author_terms, the words of just those fields, and title_words and author_words, how
+# many words the fields have, so the first two tiers are index scans too (see index.yaml).  The best title and author
+# matches are always ranked, however many books match.  Only if the third tier is cut off are some matches left out,
+# and the search says so.
+
+import math
+import re
+import concurrency
+import constants
+
+# How much a word counts for in each field.
+field_weights = {"title": 3.0, "author": 2.0, "illustrator": 1.0}
+
+word_pattern = re.compile(r"\w+")
+
+# The properties index_book keeps on every book.  They are only for searching.
+index_fields = ["search_terms", "title_terms", "title_words", "author_terms", "author_words"]
+
+# The fields that get a tier of their own, best first.
+tier_fields = ["title", "author"]
+
+
+# Returns the lowercase words of text in order, with repeats.
+def get_words(text):
+
+    if not isinstance(text, str):
+        return []
+
+    return word_pattern.findall(text.lower())
+
+
+# Returns a book's distinct words, sorted, keeping at most max_search_terms of them.
+def get_terms(book):
+
+    terms = set()
+
+    for field in field_weights:
+        terms.update(get_words(book.get(field)))
+
+    return sorted(terms)[:constants.max_search_terms]
+
+
+# Brings the book's search fields up to date with its title, author and illustrator.
+def index_book(book):
+
+    book["search_terms"] = get_terms(book)
+
+    for field in tier_fields:
+
+        words = get_words(book.get(field))
+        book[field + "_terms"] = sorted(set(words))[:constants.max_search_terms]
+        book[field + "_words"] = len(words)
+
+
+# Returns the distinct words of a query, in the order they were given.
+def get_query_terms(text):
+
+    terms = []
+
+    for word in get_words(text):
+
+        if word not in terms:
+            terms.append(word)
+
+    return terms
+
+
+# Scores how well a book matches the terms.  Each time a term appears in a field it adds the field's weight, divided
+# by the square root of the field's length so a short title that is mostly the query outranks a long one that
+# mentions it.
+def score(book, terms):
+
+    total = 0.0
+
+    for field, weight in field_weights.items():
+
+        words = get_words(book.get(field))
+
+        if len(words) == 0:
+            continue
+
+        hits = sum(1 for word in words if word in terms)
+        total += weight * hits / math.sqrt(len(words))
+
+    return total
+
+
+# Returns a function that fetches up to search_candidate_limit books with every term in the property, in order.
+def get_tier(dsClient, terms, property_name, order=None):
+
+    def fetch():
+
+        query = dsClient.query(kind=constants.books)
+
+        for term in terms:
+
+            query.add_filter(property_name, "=", term)
+
+        if order is not None:
+
+            query.order = [order]
+
+        return list(query.fetch(limit=constants.search_candidate_limit))
+
+    return fetch
+
+
+# Returns the books that have every term, best match first, and whether some matches were left out because there
+# were more than search_candidate_limit of them.  Ties go to the title, then to the oldest book.
+def find_books(dsClient, terms):
+
+    tiers = [get_tier(dsClient, terms, field + "_terms", field + "_words") for field in tier_fields]
+    tiers.append(get_tier(dsClient, terms, "search_terms"))
+
+    results = concurrency.run_all(*tiers)
+    books = {}
+
+    for tier in results:
+
+        for book in tier:
+
+            books.setdefault(book.key, book)
+
+    # The last tier is every match.  Only if it was cut off can a match be missing.
+    truncated = len(results[-1]) == constants.search_candidate_limit
+
+    wanted = set(terms)
+    ranked = sorted(books.values(), key=lambda b: (-score(b, wanted), b.get("title_lower") or "", b.key.flat_path[-1]))
+
+    return ranked, truncated
@@ -0,0 +1,105 @@
+# Turns entities into the dicts the API sends back.
+#
+# The functions here build new dicts and never change the entity they're given, so the same entity can be served
+# from entity_cache to any number of requests.  Links are built from prefixes worked out once per request by
+# get_links, instead of joining the url root, the collection name and the id together for every entity.
+
+from flask import g
+import constants
+import membership
+import search
+
+
+# The url prefixes of a request's links, like "https://host/books/".
+class Links:
+
+    def __init__(self, url_root):
+
+        self.books = url_root + constants.books + "/"
+        self.libraries = url_root + constants.libraries + "/"
+
+    def book(self, id):
+
+        return self.books + str(id)
+
+    def library(self, id):
+
+        return self.libraries + str(id)
+
+
+# Returns the Links for the current request.
+def get_links(request):
+
+    if "links" not in g:
+
+        g.links = Links(request.url_root)
+
+    return g.links
+
+
+# Properties books keep that aren't part of the API.
+hidden_book_fields = ["title_lower", "shelved"] + search.index_fields
+
+
+# { "id", "self", "title", "author", "illustrator", "library": None or {"id", "self"} }
+def book(links, entity):
+
+    id = str(entity.key.id)
+    data = dict(entity)
+    data["id"] = id
+    data["self"] = links.books + id
+
+    # title_lower, shelved and search.index_fields are only kept for searching.
+    for field in hidden_book_fields:
+
+        data.pop(field, None)
+
+    library = entity.get("library")
+
+    if library is not None:
+
+        data["library"] = dict(library)
+        data["library"]["self"] = links.libraries + library["id"]
+
+    return data
+
+
+# { "id", "self", "name", "street_address", "county", "state", "librarian", "books" }
+# In the embedded membership mode books lists every book with its id and self link.  In the indexed mode it is
+# {"self": <link to the page of the library's books>}.
+def library(links, entity):
+
+    id = str(entity.key.id)
+    data = dict(entity)
+    data["id"] = id
+    data["self"] = links.libraries + id
+
+    if membership.is_indexed():
+
+        data["books"] = {"self": links.libraries + id + "/books"}
+
+    else:
+
+        data["books"] = [{"id": b["id"], "self": links.books + b["id"]} for b in entity["books"]]
+
+    return data
+
+
+# The whole user, or only its id and email if summary is true.  library_ids, if given, become the user's
+# libraries, with self links.
+def user(links, entity, summary=False, library_ids=None):
+
+    if summary:
+
+        data = {"id": str(entity.key.id), "email": entity.get("email")}
+
+    else:
+
+        data = dict(entity)
+        data["id"] = str(entity.key.id)
+
+    if library_ids is not None:
+
+        data["libraries"] = [{"id": library_id, "self": links.libraries + library_id} for library_id in library_ids]
+
+    return data
@@ -0,0 +1,80 @@
+# Chooses where the app keeps its data.  By default that is Google Cloud Datastore.  Setting STORAGE_BACKEND=memory
+# swaps in memory_store.MemoryClient, which holds everything in this process: the whole API then runs with no
+# external service, for benchmarks, load tests and small deployments that can live without durability.
+#
+# Both backends expose the same client interface, so helper.py and the blueprints don't know which one they have.
+# Either way the client is wrapped in metrics.InstrumentedClient so every call is counted and timed.
+#
+# There is one client for the whole app.  It is only built the first time something calls it, so importing the
+# blueprints doesn't pay for finding credentials and opening a gRPC channel, and every request afterwards reuses the
+# same channel.  warm_up() builds it ahead of the first real request.
+
+import os
+import threading
+from google.cloud import datastore
+import constants
+import memory_store
+import metrics
+
+datastore_backend = "datastore"
+memory_backend = "memory"
+
+# The id warm_up() looks up.  No user has it, so the lookup finds nothing.
+warm_up_id = "warmup"
+
+backend = os.environ.get("STORAGE_BACKEND", datastore_backend)
+
+
+# Builds the client for the configured backend.
+def create_client():
+
+    if backend == memory_backend:
+        return memory_store.MemoryClient()
+
+    return datastore.Client()
+
+
+# Stands in for the client until something uses it, then creates it once and passes every call through.
+class LazyClient:
+
+    def __init__(self, factory):
+
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+
+        if self._client is None:
+
+            with self._lock:
+
+                if self._client is None:
+                    self._client = self._factory()
+
+        return self._client
+
+    def is_created(self):
+
+        return self._client is not None
+
+    def __getattr__(self, name):
+
+        return getattr(self.get_client(), name)
+
+
+lazy_client = LazyClient(create_client)
+client = metrics.InstrumentedClient(lazy_client)
+
+
+# Returns the app's client.  Every module gets the same one.
+def get_client():
+
+    return client
+
+
+# Creates the client and makes one lookup, so the channel is open before the first request needs it.
+def warm_up():
+
+    lazy_client.get_client()
+    client.get(client.key(constants.users, warm_up_id))
@@ -0,0 +1,55 @@
+# Streams large collections instead of paging them.
+#
+# GET /books, /libraries and /users normally return one page at a time.  With ?stream=true they return every
+# entity as a single JSON array, and with "Accept: application/x-ndjson" as newline-delimited JSON, one entity per
+# line.  Either way the body is sent in chunks as entities are fetched a page at a time by helper.iter_entities, so
+# the first entity goes out before the last is read and the whole collection never has to fit in memory.
+
+import json
+from flask import Response, stream_with_context
+
+ndjson = "application/x-ndjson"
+
+
+# Returns true if the client prefers NDJSON over plain JSON.
+def is_ndjson(request):
+
+    return request.accept_mimetypes.best_match(["application/json", ndjson]) == ndjson
+
+
+# Returns true if the client asked for the collection to be streamed.
+def is_requested(request):
+
+    return is_ndjson(request) or request.args.get("stream", "").lower() in ["1", "true"]
+
+
+# Builds the response for the (entities, status) returned by one of the helper.get_*_stream functions.  Errors are
+# returned as ordinary JSON.
+def respond(request, entities, status):
+
+    if status != 200:
+
+        return json.dumps(entities), status
+
+    if is_ndjson(request):
+
+        body = (json.dumps(entity) + "\n" for entity in entities)
+
+        return Response(stream_with_context(body), mimetype=ndjson)
+
+    return Response(stream_with_context(json_array(entities)), mimetype="application/json")
+
+
+# Yields the pieces of a JSON array holding the entities.
+def json_array(entities):
+
+    yield "["
+
+    separator = ""
+
+    for entity in entities:
+
+        yield separator + json.dumps(entity)
+        separator = ","
+
+    yield "]"
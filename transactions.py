@@ -0,0 +1,28 @@
+# Runs Datastore work in transactions that retry when they lose to a concurrent write.
+
+import random
+import time
+from google.api_core import exceptions
+import constants
+
+
+# Calls func inside a transaction and returns what it returns.  Anything func reads or writes through dsClient
+# joins the transaction, and its writes are committed together when it returns.  If the commit is aborted by
+# contention, func is run again after a jittered, exponentially growing pause.  After transaction_retries attempts
+# the last error is raised.
+def run_in_transaction(dsClient, func):
+
+    for attempt in range(constants.transaction_retries):
+
+        try:
+            with dsClient.transaction():
+
+                return func()
+
+        except (exceptions.Aborted, exceptions.Conflict):
+
+            if attempt == constants.transaction_retries - 1:
+                raise
+
+            # Full jitter keeps writers that collided from colliding again on the retry.
+            time.sleep(random.uniform(0, constants.transaction_backoff * 2 ** attempt))
@@ -1,12 +1,12 @@
 from flask import Blueprint, request, make_response
-from google.cloud import datastore
-from json2html import *
 import json
 import constants
 import helper
+import storage
+import streaming
 import verify_helper
 
-client = datastore.Client()
+client = storage.get_client()
 
 bp = Blueprint('user', __name__, url_prefix='/users')
 
@@ -16,7 +16,12 @@ bp = Blueprint('user', __name__, url_prefix='/users')
 def owner_get():
     if request.method == 'GET':
 
-        users, status = helper.get_user_list(client, request)
+        if streaming.is_requested(request):
+
+            users, status = helper.get_user_stream(client, request)
+            return streaming.respond(request, users, status)
+
+        users, status = helper.get_user_page(client, request)
         return json.dumps(users), status
 
     else:
@@ -1,37 +1,109 @@
 # Functions that are only used for oauth 2.0
 
-from google.cloud import datastore
 from flask import request
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from google.auth import jwt
+import requests
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import threading
+import time
+import cache
 import constants
 import config
 
 
+# Fetches Google's signing certificates and keeps them for as long as the response's Cache-Control max-age allows,
+# so verifying a token does not cost an HTTP round trip.  Connections are pooled through a single session.
+# The url can be pointed at a local stand-in with the GOOGLE_CERTS_URL environment variable.
+class CertFetcher:
+
+    def __init__(self, url, clock=time.time):
+
+        self.url = url
+        self.clock = clock
+
+        self._session = requests.Session()
+        self._certs = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get_certs(self):
+
+        with self._lock:
+
+            if self._certs is None or self._expires_at <= self.clock():
+
+                response = self._session.get(self.url, timeout=10)
+                response.raise_for_status()
+
+                self._certs = response.json()
+                self._expires_at = self.clock() + get_max_age(response.headers.get("cache-control", ""))
+
+            return self._certs
+
+
+# Returns the max-age value of a Cache-Control header, or 0 if there isn't one.
+def get_max_age(cache_control):
+
+    match = re.search(r"max-age=(\d+)", cache_control)
+
+    if match is None:
+        return 0
+
+    return int(match.group(1))
+
+
+cert_fetcher = CertFetcher(os.environ.get("GOOGLE_CERTS_URL", constants.google_certs_url))
+
+# Nonces of OAuth states that have already been used, kept until the state would have expired.
+used_states = cache.TTLCache(constants.used_state_cache_size)
+
+# Decoded claims of tokens we have already verified, keyed by a hash of the token.  Each entry lives until the
+# token's own exp.
+token_cache = cache.TTLCache(constants.token_cache_size)
+
+
+# Verifies the signature, audience, expiry and issuer of a Google ID token and returns its claims.
+# Raises ValueError if the token is not valid.  Tokens that were already verified are answered from token_cache.
+def verify_token(token):
+
+    token_hash = hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    id_info = token_cache.get(token_hash)
+
+    if id_info is not None:
+        return id_info
+
+    # https://developers.google.com/identity/sign-in/web/backend-auth
+    id_info = jwt.decode(token, certs=cert_fetcher.get_certs(), audience=config.client_id)
+
+    # Straight from the documentation
+    # https://developers.google.com/identity/sign-in/web/backend-auth
+    if id_info['iss'] not in constants.google_issuers:
+
+        raise ValueError('Wrong issuer.')
+
+    token_cache.set(token_hash, id_info, expires_at=id_info["exp"])
+
+    return id_info
+
+
 # Accepts the token we received from the client.  This function attempts to verify that the token is correct,
 # if the token is not correct, then the ValueError exception is thrown.  The except block then returns none to
 # my main function.  Otherwise, the token's sub value representing the user is returned.
 def get_sub(request):
 
-    req = requests.Request()
-
     token = get_token(request)
 
     if token is None:
 
         return None
 
-    # https://developers.google.com/identity/sign-in/web/backend-auth
     try:
-        id_info = id_token.verify_oauth2_token(token, req, config.client_id)
-
-        # Straight from the documentation
-        # https://developers.google.com/identity/sign-in/web/backend-auth
-        if id_info['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-
-            raise ValueError('Wrong issuer.')
-
-        return id_info["sub"]
+        return verify_token(token)["sub"]
 
     except ValueError:
 
@@ -58,32 +130,51 @@ def get_token(request):
     return None
 
 
-def store_state(ds_client, state):
+# Returns a new value for the OAuth state parameter: a random nonce and the time it was made, signed with
+# HMAC-SHA256.  /oauth checks it with check_state, so nothing has to be stored while the user is away at Google.
+def create_state():
+
+    payload = secrets.token_urlsafe(16) + "." + str(int(time.time()))
+
+    return payload + "." + sign_state(payload)
+
+
+# Returns true if state came from create_state, is less than state_ttl seconds old and hasn't been used before on
+# this instance.  Each state is remembered in used_states until it would have expired anyway, which stops replays.
+def check_state(state):
+
+    parts = state.split(".")
+
+    # isdigit() alone also accepts digits like "²" that int() can't read.
+    if len(parts) != 3 or not parts[1].isascii() or not parts[1].isdigit():
+
+        return False
+
+    nonce, issued_at, signature = parts
+
+    # https://docs.python.org/3/library/hmac.html#hmac.compare_digest
+    # compare_digest only takes ASCII strings, and the signature comes from the client, so compare bytes.
+    if not hmac.compare_digest(sign_state(nonce + "." + issued_at).encode("utf-8"), signature.encode("utf-8")):
+
+        return False
+
+    expires_at = int(issued_at) + constants.state_ttl
+
+    if expires_at < time.time():
 
-    state_entity = datastore.entity.Entity(key=ds_client.key(constants.states))
-    state_entity["value"] = state
-    ds_client.put(state_entity)
+        return False
 
+    if used_states.get(nonce) is not None:
 
-def state_exists(ds_client, state_to_check):
-    # https://googleapis.dev/python/datastore/latest/client.html#google.cloud.datastore.client.Client.query
-    query = ds_client.query(kind=constants.states)
-    query.add_filter("value", "=", state_to_check)
-    results = list(query.fetch())
+        return False
 
-    if len(results) != 0:
-        return True
+    used_states.set(nonce, True, expires_at=expires_at)
 
-    return False
+    return True
 
 
-def delete_state(ds_client, state):
-    # https://googleapis.dev/python/datastore/latest/client.html#google.cloud.datastore.client.Client.query
-    query = ds_client.query(kind=constants.states)
-    query.add_filter("value", "=", state)
-    results = list(query.fetch())
+def sign_state(payload):
 
-    # https://cloud.google.com/appengine/docs/standard/python/datastore/entities
-    for entity in results:
+    secret = getattr(config, "state_secret", config.client_secret)
 
-        ds_client.delete(entity.key)
+    return hmac.new(secret.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()